@@ -0,0 +1,176 @@
+# Usage :: Run the pipeline over a cohort of sessions, e.g.
+#
+#   python batch.py ./cohort/ --workers 8 > results.jsonl
+#
+# where `./cohort/` is a session directory (holding `pointi.npy`,
+# `dest_x.npy` and `dest_y.npy` like `./data/`) or a session store
+# (see store.py), a directory of such sessions, or a manifest file
+# listing one session per line. One JSON record per session is
+# printed as soon as the session finishes, so the order follows
+# completion.
+
+# global modules
+import os
+import json
+import time
+import argparse
+import contextlib
+import multiprocessing
+import concurrent.futures
+# local modules
+import main
+import cache
+import screen
+import instrument
+import stats.pca_asymmetry
+
+# NumPy's BLAS spawns one thread per core in each process. With a
+# process per core that is cores^2 threads fighting for the cores,
+# so each worker is capped to `blas_threads` threads. The variables
+# are read when NumPy is imported, which is why the workers are
+# spawned rather than forked.
+BLAS_THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                         "MKL_NUM_THREADS", "BLIS_NUM_THREADS",
+                         "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+def is_session (path):
+    return os.path.isfile(os.path.join(path, "pointi.npy")) or \
+           (os.path.isfile(path) and path.endswith(".session"))
+
+def sessions (path):
+    '''The sessions given by path: path itself if it is a session,
+    its entries that are sessions if it is a directory, and
+    otherwise the lines of the manifest file path (relative to the
+    manifest, skipping blank lines and comments starting with #).'''
+    if is_session(path):
+        return [path]
+    if os.path.isdir(path):
+        return sorted(entry.path for entry in os.scandir(path)
+                      if is_session(entry.path))
+    with open(path) as manifest:
+        lines = [line.strip() for line in manifest]
+    return [os.path.join(os.path.dirname(path), line)
+            for line in lines if line and not line.startswith("#")]
+
+def test_session (session, neighbours=None):
+    '''stage_2 => T1 for a Session. Returns its record, which also
+    holds the rate of asymmetry (see stats/pca_asymmetry.py).'''
+    left_ids, right_ids = main.stage_2(session, neighbours)
+    L, R                = main.stage_3(left_ids, right_ids, session)
+    return test_matrices(session, left_ids, L, R)
+
+def test_matrices (session, left_ids, L, R):
+    '''The record of the T1-test of the matrices L and R of session.'''
+    report = stats.pca_asymmetry.asymmetry_report(L, R)
+    return {"frames"        : len(session.frames),
+            "points"        : len(session.xy),
+            "pairs"         : len(left_ids),
+            "p_value"       : float(report["p_value"]),
+            "asymmetry_rate": float(report["asymmetry_rate"])}
+
+def full_record (directory, session=None, neighbours=None, cache_directory=None,
+                 cache_limit=2**30):
+    '''The record of the session in directory, whose stage_1 is
+    session if it already ran. With a cache_directory, the stages go
+    through that cache (see cache.py), and the record lists the
+    stages that were found in it.'''
+    if cache_directory is None:
+        return test_session(main.stage_1(directory) if session is None else session, neighbours)
+    stages = cache.Cache(cache_directory, cache_limit)
+    session, left_ids, _, L, R = stages.stages(directory, neighbours, session)
+    return dict(test_matrices(session, left_ids, L, R),
+                cached=[stage for stage, hits in stages.hits.items() if hits])
+
+def run_session (directory, neighbours=None, trace=None, profile=None,
+                 cache_directory=None, cache_limit=2**30, band=None, cells=32):
+    '''stage_1 => T1 for the session in directory. Returns a record
+    holding the p-value, or the error if the session failed. If trace
+    is a directory, the instrumentation of the session (see
+    instrument.py) is written there as `<session>.trace.json`, with
+    the stage profile run under cProfile. With a cache_directory, the
+    stages go through that cache (see full_record). With a band, the
+    session is screened on a grid of cells columns first, and only
+    goes through the full pipeline if the coarse p-value falls in the
+    band (see screen.py).'''
+    start = time.perf_counter()
+    with (instrument.Trace(directory, memory=True, profile=profile)
+          if trace else contextlib.nullcontext()) as tracing:
+        try:
+            if band is None:
+                record = dict({"session": directory},
+                              **full_record(directory, None, neighbours, cache_directory, cache_limit))
+            else:
+                full   = lambda session: full_record(directory, session, neighbours,
+                                                     cache_directory, cache_limit)
+                record = dict({"session": directory},
+                              **screen.screen_session(main.stage_1(directory), band, cells,
+                                                      neighbours, full))
+        except Exception as error:
+            record = {"session": directory,
+                      "error"  : "{}: {}".format(type(error).__name__, error)}
+    record["seconds"] = time.perf_counter() - start
+    if trace:
+        name = os.path.basename(os.path.normpath(directory))
+        tracing.dump(os.path.join(trace, name + ".trace.json"))
+    return record
+
+def run_cohort (directories, workers=None, blas_threads=1, neighbours=None,
+                trace=None, profile=None, cache_directory=None, cache_limit=2**30,
+                band=None, cells=32):
+    '''Run run_session for each directory in a process pool, and
+    yield the records as the sessions finish.'''
+    saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+    os.environ.update({name: str(blas_threads) for name in BLAS_THREAD_VARIABLES})
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as pool:
+        try:
+            futures = [pool.submit(run_session, directory, neighbours, trace, profile,
+                                   cache_directory, cache_limit, band, cells)
+                       for directory in directories]
+        finally:
+            # The workers have been started with the capped
+            # environment; the parent gets its own back.
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+def cli (argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the asymmetry test over many sessions.")
+    parser.add_argument("path",
+                        help="a session, a directory of sessions, or a manifest")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes (default: cores)")
+    parser.add_argument("--blas-threads", type=int, default=1,
+                        help="BLAS threads per worker (default: 1)")
+    parser.add_argument("--neighbours", type=int, default=None,
+                        help="use the sparse matching of stage_2 with this many neighbours")
+    parser.add_argument("--trace", default=None,
+                        help="write the instrumentation of each session into this directory")
+    parser.add_argument("--profile", default=None,
+                        help="run this stage (e.g. stage_2) under cProfile in the traces")
+    parser.add_argument("--cache", default=None,
+                        help="reuse the stages of earlier runs from this cache directory")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="size limit of the cache in MB (default: 1024)")
+    parser.add_argument("--screen", type=float, nargs=2, default=None, metavar=("LOW", "HIGH"),
+                        help="screen on a coarse grid first, running the full test only when "
+                             "the coarse p-value is in this band")
+    parser.add_argument("--cells", type=int, default=32,
+                        help="number of grid cells across the face when screening (default: 32)")
+    args = parser.parse_args(argv)
+    if args.trace:
+        os.makedirs(args.trace, exist_ok=True)
+    for record in run_cohort(sessions(args.path), args.workers,
+                             args.blas_threads, args.neighbours,
+                             args.trace, args.profile,
+                             args.cache, args.cache_size * 2**20,
+                             args.screen, args.cells):
+        print(json.dumps(record), flush=True)
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,188 @@
+# Usage :: Measure how the pipeline scales, e.g.
+#
+#   python bench.py --output bench.json
+#   python bench.py --baseline bench.json
+#
+# Each case is a synthetic session with a given number of points,
+# frames and spike order. For each case we record the wall time
+# (best of --repeat runs) and the peak memory allocated by each of
+# stage_1, stage_2, stage_3 and marietan_T1_test. The cases sweep one
+# parameter at a time around a base case. With --baseline, every
+# measurement that is more than --tolerance slower, or that peaks
+# more than --tolerance higher in memory, than the same measurement in
+# the baseline file is reported as a regression, and the exit status
+# is 1.
+#
+# Before the cases, `import main` is timed in a fresh interpreter.
+# Jobs start one interpreter per session, so the import must do no
+# work and must not load the heavy SciPy submodules; if it takes
+# more than --import-budget seconds, loads one of HEAVY_MODULES or
+# prints anything, that is a regression too.
+
+# global modules
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+# local modules
+import main
+import stats.marietan_test
+
+BASE   = {"points": 2000, "frames": 10, "spikes": 3}
+SWEEPS = {"points": [1000, 2000, 5000, 10000, 20000],
+          "frames": [10, 100, 1000, 5000],
+          "spikes": [1, 3, 6]}
+# Above this many points, the dense cost matrix of stage_2 does not
+# fit comfortably in memory, and the sparse matching is used.
+DENSE_LIMIT = 5000
+IMPORT_BUDGET = 0.5
+# The absolute slack of each measure, under which a change is noise.
+MEASURES = {"seconds": 1e-3, "peak_bytes": 2**16}
+HEAVY_MODULES = ["scipy.optimize", "scipy.spatial", "scipy.sparse",
+                 "scipy.special", "sklearn"]
+
+def synthetic_session (directory, points, frames, spikes, seed=0):
+    '''Write a session of the layout of `./data/` into directory.
+    The points are mirror pairs, jittered, around x = 0; their
+    displacements are spikes random motions common to all frames plus
+    noise, and about 1% of them are missing.'''
+    rng  = np.random.default_rng(seed)
+    half = points // 2
+    x    = rng.uniform(1, 100, half)
+    y    = rng.uniform(-100, 100, half)
+    xs   = np.concatenate([-x, x + rng.normal(0, 0.5, half)])
+    ys   = np.concatenate([y, y + rng.normal(0, 0.5, half)])
+    pointi  = np.tile(np.concatenate([xs, ys]), (frames, 1))
+    motions = rng.normal(size=(spikes, 2*len(xs))) * np.sqrt(10 + 10*np.arange(spikes))[::-1, None]
+    dest    = rng.normal(size=(frames, spikes)) @ motions + rng.normal(size=(frames, 2*len(xs)))
+    dest[rng.random(dest.shape) < 0.01] = np.nan
+    np.save(os.path.join(directory, "pointi.npy"), pointi)
+    np.save(os.path.join(directory, "dest_x.npy"), dest[:, :len(xs)])
+    np.save(os.path.join(directory, "dest_y.npy"), dest[:, len(xs):])
+
+def measure (function, repeat):
+    '''Run function once under tracemalloc for the peak memory,
+    which also warms up lazy imports and caches, then repeat times
+    for the best wall time. Returns the result, the time and the
+    peak.'''
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    seconds = float("inf")
+    for _ in range(repeat):
+        start   = time.perf_counter()
+        result  = function()
+        seconds = min(seconds, time.perf_counter() - start)
+    return result, seconds, peak
+
+def import_cost (module="main", repeat=3):
+    '''Import module in repeat fresh interpreters, from an empty
+    directory so that an import reading `./data` fails. Returns the
+    best time, the heavy modules it loaded and what it printed.'''
+    code = ("import sys, time, json\n"
+            "start = time.perf_counter()\n"
+            "import {}\n"
+            "seconds = time.perf_counter() - start\n"
+            "print(json.dumps([seconds, [m for m in {} if m in sys.modules]]))"
+            ).format(module, HEAVY_MODULES)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    seconds = float("inf")
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, "-c", code], cwd=directory, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            *printed, last = output.splitlines()
+            time_, heavy = json.loads(last)
+            seconds = min(seconds, time_)
+    return {"module": module, "seconds": seconds, "heavy": heavy, "printed": printed}
+
+def run_case (points, frames, spikes, repeat=3):
+    '''Measure the stages on one synthetic session, testing it with
+    its own spike order.'''
+    neighbours = None if points <= DENSE_LIMIT else 10
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic_session(directory, points, frames, spikes)
+        session, *stage_1 = measure(lambda: main.stage_1(directory), repeat)
+    (left_ids, right_ids), *stage_2 = measure(lambda: main.stage_2(session, neighbours), repeat)
+    (L, R), *stage_3 = measure(lambda: main.stage_3(left_ids, right_ids, session), repeat)
+    _, *T1 = measure(lambda: stats.marietan_test.marietan_T1_test(L, R, spikes), repeat)
+    case = {"points": points, "frames": frames, "spikes": spikes}
+    return [dict(case, stage=stage, seconds=seconds, peak_bytes=peak)
+            for stage, (seconds, peak) in [("stage_1", stage_1), ("stage_2", stage_2),
+                                           ("stage_3", stage_3), ("marietan_T1_test", T1)]]
+
+def cases (sweeps):
+    '''The base case, and the cases varying one parameter of it.'''
+    result = [dict(BASE)]
+    for parameter, values in sweeps.items():
+        result += [dict(BASE, **{parameter: value}) for value in values
+                   if value != BASE[parameter]]
+    return result
+
+def key (record):
+    return (record["points"], record["frames"], record["spikes"], record["stage"])
+
+def regressions (records, baseline, tolerance):
+    '''The records whose time or peak memory exceeds that of the
+    matching records of the baseline by more than the fraction
+    tolerance (and the slack in MEASURES), once per measure, with the
+    "measure" and its "baseline" value.'''
+    before = {key(record): record for record in baseline}
+    return [dict(record, measure=measure, baseline=before[key(record)][measure])
+            for record in records if key(record) in before
+            for measure, slack in MEASURES.items()
+            if record[measure] > (1 + tolerance) * before[key(record)][measure] + slack]
+
+def cli (argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the pipeline.")
+    parser.add_argument("--output", help="write the measurements to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed increase of time and peak memory against the baseline (default: 0.25)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per measurement (default: 3)")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET,
+                        help="allowed time of `import main` (default: {} s)".format(IMPORT_BUDGET))
+    for parameter, values in SWEEPS.items():
+        parser.add_argument("--" + parameter, type=int, nargs="*", default=values,
+                            help="values of {} to sweep (default: {})".format(parameter, values))
+    args = parser.parse_args(argv)
+    imported = import_cost(repeat=args.repeat)
+    print("import {module:<38} {seconds:10.4f} s".format(**imported), flush=True)
+    failed = bool(imported["seconds"] > args.import_budget or imported["heavy"] or imported["printed"])
+    if failed:
+        print("REGRESSION import {module}: {seconds:.4f} s against a budget of {budget} s, "
+              "loads {heavy}, prints {printed}".format(budget=args.import_budget, **imported))
+    records = []
+    for case in cases({parameter: getattr(args, parameter) for parameter in SWEEPS}):
+        for record in run_case(repeat=args.repeat, **case):
+            print("{points:>6} points {frames:>5} frames {spikes:>2} spikes  "
+                  "{stage:<17} {seconds:10.4f} s {peak_bytes:>12} B".format(**record),
+                  flush=True)
+            records.append(record)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"machine": platform.platform(),
+                       "python" : platform.python_version(),
+                       "numpy"  : np.__version__,
+                       "import" : imported,
+                       "records": records}, file, indent=1)
+    if args.baseline:
+        with open(args.baseline) as file:
+            slower = regressions(records, json.load(file)["records"], args.tolerance)
+        for record in slower:
+            print("REGRESSION {points} points {frames} frames {spikes} spikes {stage}: "
+                  "{measure} {value:.6g} against {baseline:.6g}"
+                  .format(value=record[record["measure"]], **record))
+        failed = failed or slower
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,213 @@
+# Usage :: Inspect or clear a stage cache, e.g.
+#
+#   python batch.py ./cohort/ --cache ./cache/ > results.jsonl
+#   python cache.py ./cache/
+#   python cache.py ./cache/ --clear
+#
+# A persistent cache of the outputs of stage_1, stage_2 and stage_3,
+# so that rerunning sessions (with other spike orders, thresholds or
+# regions) only reruns the stages whose inputs changed. Each entry is
+# addressed by a hash of what the stage depends on:
+#
+#   stage_1  the contents of the input files of the session,
+#   stage_2  the locations xy of the session, and neighbours,
+#   stage_3  the keys of its stage_1 and stage_2 entries.
+#
+# The pairing of stage_2, the costliest entry, thus only depends on
+# the layout of the landmarks, and sessions recorded with the same
+# layout share it. The digest of a file is itself remembered by its
+# path, size and modification time, so unchanged files are not read
+# again.
+#
+# Each entry is one `.npz` file under `<cache>/<stage>/`, written
+# under a temporary name and renamed, so concurrent workers never see
+# a partial entry and may race to write the same one. The
+# modification time of an entry is its last use: a hit touches it,
+# and when the cache exceeds its size limit, the least recently used
+# entries are deleted first. The pairings are small and slow to
+# recompute, so they are only deleted once the other entries are
+# gone. The remembered digests of the files, under `<cache>/digests/`,
+# count toward the limit too, and are touched and deleted like the
+# entries, so they go along with the entries they were used for.
+
+# global modules
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+# local modules
+import main
+import instrument
+
+STAGES = ["stage_1", "stage_2", "stage_3"]
+
+def digest (*parts):
+    '''The hex digest of parts, which are bytes or JSON values.'''
+    h = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        data = part if isinstance(part, bytes) else json.dumps(part).encode()
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+def input_files (directory):
+    '''The files stage_1 reads for the session at directory.'''
+    if os.path.isfile(directory):
+        return [directory]
+    return [os.path.join(directory, name) for name in ["pointi.npy", "dest_x.npy", "dest_y.npy"]]
+
+class Cache:
+    '''The cache in directory, holding at most limit bytes. hits and
+    misses count the lookups of each stage made through this
+    object.'''
+    def __init__ (self, directory, limit=2**30):
+        self.directory = directory
+        self.limit     = limit
+        self.hits      = dict.fromkeys(STAGES, 0)
+        self.misses    = dict.fromkeys(STAGES, 0)
+
+    def path (self, stage, key):
+        return os.path.join(self.directory, stage, key + ".npz")
+
+    def get (self, stage, key):
+        '''The arrays of the entry, or None.'''
+        path = self.path(stage, key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            # Missing, being evicted, or unreadable: a miss.
+            self.misses[stage] += 1
+            instrument.count("cache_misses")
+            return None
+        self.hits[stage] += 1
+        instrument.count("cache_hits")
+        return arrays
+
+    def put (self, stage, key, **arrays):
+        path = self.path(stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = "{}.tmp{}.npz".format(path[:-len(".npz")], os.getpid())
+        np.savez(temporary, **arrays)
+        os.replace(temporary, path)
+        self.evict()
+
+    def entries (self):
+        '''(is a pairing, last use, size, path) of each entry, and of
+        each remembered file digest.'''
+        result = []
+        for stage in STAGES + ["digests"]:
+            try:
+                scan = list(os.scandir(os.path.join(self.directory, stage)))
+            except FileNotFoundError:
+                continue
+            for entry in scan:
+                if (stage == "digests" or entry.name.endswith(".npz")) and ".tmp" not in entry.name:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    result.append((stage == "stage_2", stat.st_mtime, stat.st_size, entry.path))
+        return result
+
+    def evict (self):
+        '''Delete the least recently used entries, pairings last, until
+        the cache fits in its limit.'''
+        entries = sorted(self.entries())
+        size    = sum(entry[2] for entry in entries)
+        for _, _, entry_size, path in entries:
+            if size <= self.limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def file_digest (self, path):
+        '''The digest of the contents of the file at path.'''
+        stat = os.stat(path)
+        memo = os.path.join(self.directory, "digests",
+                            digest(os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+        try:
+            with open(memo) as file:
+                result = file.read()
+            os.utime(memo)
+            return result
+        except FileNotFoundError:
+            pass
+        with open(path, "rb") as file:
+            result = hashlib.file_digest(file, lambda: hashlib.blake2b(digest_size=20)).hexdigest()
+        os.makedirs(os.path.dirname(memo), exist_ok=True)
+        temporary = memo + ".tmp{}".format(os.getpid())
+        with open(temporary, "w") as file:
+            file.write(result)
+        os.replace(temporary, memo)
+        self.evict()
+        return result
+
+    def stats (self):
+        entries = self.entries()
+        return {"hits"   : dict(self.hits),
+                "misses" : dict(self.misses),
+                "entries": len(entries),
+                "bytes"  : sum(entry[2] for entry in entries),
+                "limit"  : self.limit}
+
+    def stages (self, directory, neighbours=None, session=None):
+        '''session, left_ids, right_ids, L and R of the session at
+        directory, as main.stage_1, stage_2 and stage_3 give them,
+        running each stage only on a miss. If stage_1 already ran, its
+        session is given, and only the key of stage_1 is computed.'''
+        key_1 = digest("stage_1", *map(self.file_digest, input_files(directory)))
+        if session is not None or os.path.isfile(directory):
+            # A session store is opened as a memory map, which is
+            # faster than any entry, and a given session needs none,
+            # so only its key is used.
+            session = main.stage_1(directory) if session is None else session
+        elif (entry_1 := self.get("stage_1", key_1)) is not None:
+            xy      = entry_1["xy"]
+            session = main.Session(xy      = xy,
+                                   dxdy    = entry_1["dxdy"],
+                                   old_ids = entry_1["old_ids"],
+                                   frames  = range(0, len(entry_1["dxdy"])),
+                                   x_mean  = float(xy[:, 0].mean()),
+                                   valid   = entry_1.get("valid"))
+        else:
+            session = main.stage_1(directory)
+            self.put("stage_1", key_1, xy=session.xy, dxdy=session.dxdy, old_ids=session.old_ids,
+                     valid=session.valid)
+        key_2   = digest("stage_2", session.xy.tobytes(), session.xy.shape, neighbours)
+        entry_2 = self.get("stage_2", key_2)
+        if entry_2 is None:
+            left_ids, right_ids = main.stage_2(session, neighbours)
+            self.put("stage_2", key_2, left_ids=left_ids, right_ids=right_ids)
+        else:
+            left_ids, right_ids = entry_2["left_ids"], entry_2["right_ids"]
+        key_3   = digest("stage_3", key_1, key_2)
+        entry_3 = self.get("stage_3", key_3)
+        if entry_3 is None:
+            L, R = main.stage_3(left_ids, right_ids, session)
+            self.put("stage_3", key_3, L=L, R=R)
+        else:
+            L, R = entry_3["L"], entry_3["R"]
+        return session, left_ids, right_ids, L, R
+
+def cli (argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or clear a stage cache.")
+    parser.add_argument("directory", help="the cache directory")
+    parser.add_argument("--clear", action="store_true", help="delete all the entries")
+    args = parser.parse_args(argv)
+    if args.clear:
+        for name in STAGES + ["digests"]:
+            shutil.rmtree(os.path.join(args.directory, name), ignore_errors=True)
+    stats = Cache(args.directory).stats()
+    json.dump({"entries": stats["entries"], "bytes": stats["bytes"]}, sys.stdout)
+    print()
+
+if __name__ == "__main__":
+    cli()
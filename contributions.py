@@ -0,0 +1,77 @@
+# Usage :: Map where on the face the asymmetry lives, e.g.
+#
+#   python contributions.py ./data/ --heatmap map.svg > pairs.jsonl
+#
+# which prints the contribution of each pair (left_ids[j],
+# right_ids[j]) of stage_2 to T1 as a JSON line, and draws them as a
+# heatmap over the coordinates of stage_1.
+#
+# The contribution of a pair is the drop of T1 when its columns are
+# left out of L and R, so that pairs adding to the asymmetry are
+# positive, and pairs masking it are negative. The contributions of
+# all the pairs come from one eigendecomposition of each of L and R,
+# each pair being a rank two downdate of their Gram matrices (see
+# pair_contributions in stats/influence.py).
+#
+# The heatmap is an SVG file, so it needs no plotting library: each
+# point is a disc colored by the contribution of its pair, from blue
+# (negative) through white to red (positive), on a scale symmetric
+# around 0.
+
+# global modules
+import json
+import argparse
+import numpy as np
+# local modules
+import main
+import stats.influence
+
+def color (value):
+    '''The color of value in [-1, 1], from blue through white to red,
+    as an SVG hex string.'''
+    fade = int(round(255 * (1 - min(abs(value), 1))))
+    rgb  = (255, fade, fade) if value > 0 else (fade, fade, 255)
+    return "#{:02x}{:02x}{:02x}".format(*rgb)
+
+def heatmap (xy, left_ids, right_ids, contribution, path):
+    '''Write the SVG heatmap of the contribution of each pair over the
+    points xy to path.'''
+    ids    = np.concatenate([left_ids, right_ids])
+    values = np.concatenate([contribution, contribution])
+    scale  = np.abs(contribution).max() or 1.0
+    low, high = xy[ids].min(axis=0), xy[ids].max(axis=0)
+    size   = np.maximum(high - low, 1e-9)
+    radius = 0.5 * np.sqrt(size.prod() / len(ids))
+    low, size = low - 2*radius, size + 4*radius
+    with open(path, "w") as file:
+        file.write('<svg xmlns="http://www.w3.org/2000/svg" viewBox="{} {} {} {}">\n'
+                   .format(low[0], low[1], size[0], size[1]))
+        file.write('<rect x="{}" y="{}" width="{}" height="{}" fill="#808080"/>\n'
+                   .format(low[0], low[1], size[0], size[1]))
+        for (x, y), value in zip(xy[ids], values):
+            file.write('<circle cx="{:.6g}" cy="{:.6g}" r="{:.6g}" fill="{}"/>\n'
+                       .format(x, y, radius, color(value / scale)))
+        file.write("</svg>\n")
+
+def cli (argv=None):
+    parser = argparse.ArgumentParser(description="Map the contribution of each pair of landmarks to T1.")
+    parser.add_argument("session", help="a session directory or store")
+    parser.add_argument("--neighbours", type=int, default=None,
+                        help="use the sparse matching of stage_2 with this many neighbours")
+    parser.add_argument("--heatmap", default=None, help="also draw the contributions to this SVG file")
+    args = parser.parse_args(argv)
+    session             = main.stage_1(args.session)
+    left_ids, right_ids = main.stage_2(session, args.neighbours)
+    L, R                = main.stage_3(left_ids, right_ids, session)
+    result              = stats.influence.pair_contributions(L, R)
+    for j in np.argsort(result["contribution"])[::-1]:
+        print(json.dumps({"left"        : int(session.old_ids[left_ids[j]]),
+                          "right"       : int(session.old_ids[right_ids[j]]),
+                          "x"           : float(session.xy[left_ids[j], 0]),
+                          "y"           : float(session.xy[left_ids[j], 1]),
+                          "contribution": float(result["contribution"][j])}))
+    if args.heatmap:
+        heatmap(session.xy, left_ids, right_ids, result["contribution"], args.heatmap)
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,135 @@
+# Opt-in instrumentation of the pipeline. Nothing is recorded unless
+# a Trace is active:
+#
+#   with instrument.Trace("./data", memory=True, profile="stage_2") as trace:
+#       session = main.stage_1("./data")
+#       ...
+#   trace.dump("./data.trace.json")
+#
+# While a Trace is active, each `stage` records its wall time, CPU
+# time and (with memory=True) the peak memory it allocated on top of
+# what was allocated when it started; `count` and `size` record how
+# often expensive calls happen and on which matrix shapes. The stage
+# named by `profile` is also run under cProfile.
+#
+# When no Trace is active, `stage` returns a shared null context and
+# `count` and `size` return at once, so the hooks can stay in
+# production code. The active Trace lives in a context variable, so
+# threads (and asyncio tasks) each see their own.
+
+# global modules
+import time
+import functools
+import contextlib
+import contextvars
+# json, cProfile, pstats and tracemalloc are imported when a Trace
+# needs them, which keeps this module cheap to import.
+
+_current = contextvars.ContextVar("trace", default=None)
+_NULL    = contextlib.nullcontext()
+
+class Trace:
+    '''The record of one session: its stages in the order they
+    finish, the counters, and the shapes seen by each size hook.'''
+    def __init__ (self, session=None, memory=False, profile=None):
+        self.memory  = memory
+        self.profile = profile
+        self.record  = {"session": session, "stages": [], "counts": {}, "sizes": {}}
+        self._stack  = []
+    def __enter__ (self):
+        self._token = _current.set(self)
+        if self.memory:
+            import tracemalloc
+            self._tracing = tracemalloc.is_tracing()
+            if not self._tracing:
+                tracemalloc.start()
+        return self
+    def __exit__ (self, *exc):
+        _current.reset(self._token)
+        if self.memory and not self._tracing:
+            import tracemalloc
+            tracemalloc.stop()
+        return False
+    def to_json (self):
+        import json
+        return json.dumps(self.record, indent=1)
+    def dump (self, path):
+        with open(path, "w") as file:
+            file.write(self.to_json())
+
+@contextlib.contextmanager
+def _stage (trace, name):
+    record = {"stage": name, "depth": len(trace._stack)}
+    if trace.memory:
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        if trace._stack:
+            # The peak of the enclosing stage so far, before we reset it.
+            trace._stack[-1]["peak"] = max(trace._stack[-1]["peak"], peak)
+        tracemalloc.reset_peak()
+        frame = {"start": current, "peak": current}
+    else:
+        frame = {}
+    trace._stack.append(frame)
+    profiler = None
+    if name == trace.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    wall, cpu = time.perf_counter(), time.process_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        record["wall_seconds"] = time.perf_counter() - wall
+        record["cpu_seconds"]  = time.process_time() - cpu
+        trace._stack.pop()
+        if trace.memory:
+            peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            record["peak_bytes"] = peak - frame["start"]
+            if trace._stack:
+                trace._stack[-1]["peak"] = max(trace._stack[-1]["peak"], peak)
+        if profiler:
+            import io
+            import pstats
+            text = io.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(30)
+            record["profile"] = text.getvalue()
+        trace.record["stages"].append(record)
+
+def stage (name):
+    '''A context manager recording the stage name in the active
+    Trace, if any.'''
+    trace = _current.get()
+    if trace is None:
+        return _NULL
+    return _stage(trace, name)
+
+def staged (function):
+    '''Record each call of function as a stage named after it.'''
+    @functools.wraps(function)
+    def wrapper (*args, **kwargs):
+        trace = _current.get()
+        if trace is None:
+            return function(*args, **kwargs)
+        with _stage(trace, function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+def count (name, n=1):
+    '''Add n to the counter name of the active Trace, if any.'''
+    trace = _current.get()
+    if trace is not None:
+        counts = trace.record["counts"]
+        counts[name] = counts.get(name, 0) + n
+
+def size (name, shape):
+    '''Count the shape seen by the hook name in the active Trace, if
+    any.'''
+    trace = _current.get()
+    if trace is not None:
+        sizes = trace.record["sizes"].setdefault(name, {})
+        shape = "x".join(map(str, shape))
+        sizes[shape] = sizes.get(shape, 0) + 1
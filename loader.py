@@ -0,0 +1,108 @@
+# Load a session stored in the per-frame layout of the archived
+# profiles (see `.archive/old_main_dir/profile.py`): one archive
+# `disp_frame{frame}_pointf_ref` per frame, holding the ids `idx`
+# seen in that frame, their initial locations `pointi` and their
+# final locations `pointf`.
+#
+# The files usually sit on a slow network mount, where the latency
+# of each read dominates. We therefore read several frames at once
+# in a bounded thread pool; each thread also decodes its frame, so
+# that decoding overlaps with the reads of the others. The frames
+# still come out in frame order. A profile may also hold its own
+# `load`, called like np.load on the path of a frame, e.g. to read
+# from another store or to test slow and failing reads.
+#
+# Frames that cannot be read are left out of the session, whose
+# `frames` then lists the numbers of the frames it holds, so later
+# stages can tell where the gaps are.
+
+# global modules
+import time
+import warnings
+import itertools
+import collections
+import concurrent.futures
+import numpy as np
+from typing import NamedTuple
+# local modules
+import main
+
+class Frame (NamedTuple):
+    '''One decoded frame, over all the ids of the profile. Entries of
+    ids that are not seen in the frame are NaN.'''
+    frame  : int
+    pointi : np.ndarray # (2*points,), all x's followed by all y's
+    dest_x : np.ndarray # (points,)
+    dest_y : np.ndarray # (points,)
+
+def decode (frame, content, ids):
+    '''Scatter the content of a frame file onto the ids of the
+    profile.'''
+    ids    = np.asarray(ids)
+    n      = len(ids)
+    idx    = np.asarray(content['idx'])
+    pointi = np.asarray(content['pointi'], dtype=float)
+    pointf = np.asarray(content['pointf'], dtype=float)
+    # Check sanity
+    assert(len(idx) == len(pointi) == len(pointf))
+    at     = np.searchsorted(ids, idx)
+    known  = at < n
+    known[known] = ids[at[known]] == idx[known]
+    at, pointi, pointf = at[known], pointi[known], pointf[known]
+    result = Frame(frame, np.full(2*n, np.nan), np.full(n, np.nan), np.full(n, np.nan))
+    result.pointi[at]     = pointi[:, 0]
+    result.pointi[n + at] = pointi[:, 1]
+    result.dest_x[at]     = pointf[:, 0] - pointi[:, 0]
+    result.dest_y[at]     = pointf[:, 1] - pointi[:, 1]
+    return result
+
+def read_frame (profile, frame, retries=2, backoff=0.5):
+    '''Read and decode one frame. A missing file gives None at once;
+    other errors are retried `retries` times, waiting backoff, 2 *
+    backoff, .. seconds in between, before giving None as well.'''
+    path = profile['get_file'](frame)
+    load = profile.get('load', np.load)
+    for attempt in range(retries + 1):
+        try:
+            with load(path, allow_pickle=True) as content:
+                return decode(frame, content, profile['ids'])
+        except FileNotFoundError:
+            warnings.warn("frame {} is missing: {}".format(frame, path))
+            return None
+        except Exception as error:
+            if attempt == retries:
+                warnings.warn("frame {} could not be read: {}".format(frame, error))
+                return None
+            time.sleep(backoff * 2**attempt)
+
+def read_frames (profile, workers=8, retries=2, backoff=0.5):
+    '''Yield the decoded frames of the profile in frame order, None
+    for the frames that could not be read. At most 2 * workers frames
+    are read ahead of the consumer.'''
+    frames = iter(profile['frames'])
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        def submit (frame):
+            return pool.submit(read_frame, profile, frame, retries, backoff)
+        pending = collections.deque(map(submit, itertools.islice(frames, 2*workers)))
+        while pending:
+            result = pending.popleft().result()
+            for frame in frames:
+                pending.append(submit(frame))
+                break
+            yield result
+
+def load_session (profile, workers=8, retries=2, backoff=0.5):
+    '''Read the frames of the profile and cleanse them into a
+    main.Session, whose frames are the numbers of the frames read.
+    Frames that could not be read are left out, with a warning listing
+    them.'''
+    decoded = list(read_frames(profile, workers, retries, backoff))
+    frames  = [f for f in decoded if f is not None]
+    skipped = [frame for frame, f in zip(profile['frames'], decoded) if f is None]
+    assert len(frames) > 0, "No frame of {} could be read.".format(profile.get('name'))
+    if skipped:
+        warnings.warn("frames {} of {} were left out.".format(skipped, profile.get('name')))
+    session = main.cleanse(np.stack([f.pointi for f in frames]),
+                           np.stack([f.dest_x for f in frames]),
+                           np.stack([f.dest_y for f in frames]))
+    return session._replace(frames=[f.frame for f in frames])
@@ -1,120 +1,303 @@
+import os
 import numpy as np
-import math
-import scipy
+import warnings
+from typing import NamedTuple
+import instrument
 import stats.marietan_test
+import stats.pca_asymmetry
+import stats.influence
 
-# Utils
-def dxdy_frame_concat (dxdy, frame, ids, flip):
-    result = []
-    for id in ids:
-        dx = dxdy[frame][id][0]
-        dy = dxdy[frame][id][1]
-        if flip: dx = -dx
-        result += [dx,dy] # concat
-    return result
+# Stage 1: raw_data => data (points, dxdy)
+class Session (NamedTuple):
+    '''The cleansed data of a session. The points of the face are
+    indexed by their ids 0, .., n-1. `xy[id]` is the `(x,y)` location
+    of the id, `dxdy[frame, id]` is its `[dx, dy]` increment in the
+    frame, and `old_ids[id]` is the column of the id in the raw
+    data. `valid[frame, id]` tells whether that increment was
+    recorded, as missing ones are 0 in dxdy; it is None when
+    unknown.'''
+    xy      : np.ndarray # (points, 2)
+    dxdy    : np.ndarray # (frames, points, 2)
+    old_ids : np.ndarray # (points,)
+    frames  : range      # or the numbers of the frames kept, see loader.py
+    x_mean  : float
+    valid   : np.ndarray = None # (frames, points)
 
-def norm (x,y):
-    return math.sqrt(x**2+y**2)
+@instrument.staged
+def cleanse (pointi, dest_x, dest_y):
+    '''Turn the raw arrays into a Session. `pointi` has shape
+    (frames, 2*points), holding all x-coordinates followed by all
+    y-coordinates; `dest_x` and `dest_y` have shape (frames,
+    points).'''
+    amount_of_points = pointi.shape[1]//2
+    xs = pointi[:, :amount_of_points]
+    ys = pointi[:, amount_of_points:]
+    # We assume that each pointi is constant over different frames.
+    # Points missing in some frames are fine, but a point must not
+    # move.
+    both = ~np.isnan(xs) & ~np.isnan(xs[0])
+    moved = np.any(both & ((xs != xs[0]) | (ys != ys[0])), axis=0)
+    if moved.any():
+        warnings.warn("old ids {} have more than one location."
+                      .format(np.flatnonzero(moved).tolist()))
+    old_ids = np.flatnonzero(~np.isnan(xs[0]))
+    xy      = np.stack([xs[0, old_ids], ys[0, old_ids]], axis=1)
+    dxdy    = np.stack([dest_x[:, old_ids], dest_y[:, old_ids]], axis=2)
+    valid   = ~np.isnan(dxdy).any(axis=2)
+    # If dx or dy is missing, treat it as 0.
+    np.nan_to_num(dxdy, copy=False, nan=0)
+    return Session(xy      = xy,
+                   dxdy    = dxdy,
+                   old_ids = old_ids,
+                   frames  = range(0, pointi.shape[0]),
+                   x_mean  = float(xy[:, 0].mean()),
+                   valid   = valid)
 
-# Stage 1: raw_data => data (points, dxdy)
-def stage_1 ():
+@instrument.staged
+def stage_1 (directory="./data"):
+    if os.path.isfile(directory):
+        # A session store; see store.py.
+        import store
+        return store.open_session(directory)
     ## Raw data
-    __pointi=np.load("./data/pointi.npy")
-    # __pointf=np.load("pointf.npy")  # We do not use this file.
-    __dest_x=np.load("./data/dest_x.npy")
-    __dest_y=np.load("./data/dest_y.npy")
+    with instrument.stage("load"):
+        __pointi=np.load(directory + "/pointi.npy")
+        # __pointf=np.load("pointf.npy")  # We do not use this file.
+        __dest_x=np.load(directory + "/dest_x.npy")
+        __dest_y=np.load(directory + "/dest_y.npy")
     ## Raw data cleansing
-    frames=range(0,__pointi.shape[0])
-    amount_of_points=__pointi.shape[1]//2
-    __points_from_id={}
-    __points_from_old_id={}
-    __id=0
-    for old_id in range(0,amount_of_points):
-        if not np.isnan(__pointi[0][old_id]):
-            x = __pointi[0][old_id]
-            y = __pointi[0][old_id+amount_of_points]
-            # We assume that each __pointi is constant over different frames.
-            __points_from_id[__id] = ([x,y], old_id)
-            __points_from_old_id[old_id] = ([x,y], __id)
-            __id+=1
-    def effective_old_ids ():
-        return __points_from_old_id.keys()
-    def effective_p (old_id):
-        return old_id in effective_old_ids()
-    # We assume that each __pointi is constant over different frames.
-    def xy (id):
-        return __points_from_id[id][0]
-    def x (id):
-        return xy(id)[0]
-    def y (id):
-        return xy(id)[1]
-    def old_id_of (id):
-        return __points_from_id[id][1]
-    def old_ids ():
-        return range(0,amount_of_points)
-    def ids ():
-        return __points_from_id.keys()
-    __x_mean  = 0
-    for id in ids():
-        __x_mean += x(id)
-    __x_mean = __x_mean / len(ids())
-    __dxdy={}
-    for frame in frames:
-        __dxdy[frame]={}
-        for id in ids():
-            dx = __dest_x[frame][old_id_of(id)]
-            dy = __dest_y[frame][old_id_of(id)]
-            # If dx or dy is missing, treat it as 0.
-            if np.isnan(dx): dx = 0
-            if np.isnan(dy): dy = 0
-            __dxdy[frame][id] = [dx,dy]
-    # ids is the collection of ids. xy is the collection of point
-    # locations: xy(id) is the location of the id. dxdy[id] gives
-    # the vector increment assigned to id.
-    data = [xy, __dxdy, ids(), frames, __x_mean]
-    return data
+    return cleanse(__pointi, __dest_x, __dest_y)
+
+# Stage 1, optionally: data => data without the head motion
+#
+# The displacements dxdy also hold the motion of the head, which is
+# the same for the left and the right side and so blurs the test. We
+# model it in each frame as a rigid motion (or a similarity, if the
+# head may also move to or from the camera) taking the locations
+# z = xy to z + dxdy[frame], fit it to all the points (or to stable
+# anchors) by least squares and subtract it. In two dimensions the
+# Procrustes problem has a closed form: with the anchors centralized,
+# z_c in the source and w_c in the frame, and the 2 x 2 matrix
+# H = sum z_c w_c^t, the best rotation has the angle
+#
+#   a = atan2(H[0,1] - H[1,0], H[0,0] + H[1,1]),
+#
+# and the best scale is |(H[0,0] + H[1,1], H[0,1] - H[1,0])| /
+# sum |z_c|^2. So all the frames are fitted at once by one einsum,
+# with no SVD and no loop over the frames.
+@instrument.staged
+def remove_head_motion (session, similarity=False, anchors=None):
+    '''The session with the rigid motion of the head (or with
+    similarity, the similarity) removed from each frame of dxdy. The
+    motion is fitted to the points of ids anchors, by default to all
+    of them.'''
+    ids  = slice(None) if anchors is None else np.asarray(anchors)
+    z    = session.xy[ids]
+    assert len(z) >= 2, "The head motion needs 2 anchors."
+    # With z_c = z - mean(z), H = sum z_c z_c^t + sum z_c d^t over the
+    # anchors, where d is their displacement. Its second term and the
+    # mean displacement come from one product.
+    z_c     = session.xy - z.mean(axis=0)
+    A       = np.concatenate([z_c, np.ones((len(z_c), 1))], axis=1)
+    moments = A[ids].T @ session.dxdy[:, ids]
+    H       = z_c[ids].T @ z_c[ids] + moments[:, :2]
+    d_mean  = moments[:, 2] / len(z)
+    cos     = H[:, 0, 0] + H[:, 1, 1]
+    sin     = H[:, 0, 1] - H[:, 1, 0]
+    angle   = np.arctan2(sin, cos)
+    scale   = np.hypot(cos, sin) / np.sum(z_c[ids]**2) if similarity else 1
+    R       = np.empty((len(angle), 2, 2))
+    R[:, 0, 0] = R[:, 1, 1] = scale * np.cos(angle)
+    R[:, 1, 0] = scale * np.sin(angle)
+    R[:, 0, 1] = -R[:, 1, 0]
+    # The motion of a point is its image R z_c + mean(z) + d_mean minus
+    # its location, i.e. (R - I) z_c + d_mean, which is subtracted from
+    # its displacement.
+    B     = np.concatenate([np.swapaxes(np.eye(2) - R, -1, -2), -d_mean[:, None]], axis=1)
+    dxdy  = A @ B
+    dxdy += session.dxdy
+    return session._replace(dxdy=dxdy)
 
 # Stage 2: data => (left_points, right_points)
-def stage_2 (xy, dxdy, ids, frames, x_mean):
-    def x (id):
-        return xy(id)[0]
-    def y (id):
-        return xy(id)[1]
-    def cost (id_0, id_1):
-        x_0_mirrored = 2*x_mean - x(id_0)
-        return norm(x_0_mirrored - x(id_1),
-                    y(id_0)      - y(id_1))
-    cost_matrix = [[cost(id_0,id_1) for id_0 in ids] for id_1 in ids]
-    match = scipy.optimize.linear_sum_assignment(cost_matrix)[1]
-    # TODO Use Hungarian Algorithm to find pairs on the face.
-    def compute_left_right_ids ():
-        left, right = [], []
+def mirrored (session):
+    '''The locations of the points mirrored along the vertical line
+    x = x_mean.'''
+    result = session.xy.copy()
+    result[:, 0] = 2*session.x_mean - result[:, 0]
+    return result
+
+def dense_match (xy, xy_mirrored):
+    '''Solve the assignment problem with the Hungarian algorithm,
+    where the cost of matching id_1 to id_0 is the distance from id_1
+    to the mirror image of id_0.'''
+    import scipy.optimize
+    import scipy.spatial.distance
+    with instrument.stage("cost_matrix"):
+        cost_matrix = scipy.spatial.distance.cdist(xy, xy_mirrored)
+    instrument.count("assignments")
+    instrument.size("assignment", cost_matrix.shape)
+    with instrument.stage("assignment"):
+        return scipy.optimize.linear_sum_assignment(cost_matrix)[1]
+
+def sparse_match (xy, xy_mirrored, neighbours, tolerance=0.01):
+    '''Like dense_match, but only the `neighbours` nearest mirror
+    images of each point are candidates, so the cost matrix is sparse
+    and the result is an approximation. Each point may also be matched
+    to itself, at the cost of its distance to its own mirror image, so
+    that a full matching always exists. With too few candidates, that
+    fallback also pairs points far from the midline with themselves,
+    so the candidates double as long as more than a `tolerance` share
+    of the points are paired with themselves at a higher cost than
+    any other pair. The sparse assignment is solved by the auction of
+    midline.py.'''
+    import scipy.spatial
+    import midline
+    n    = len(xy)
+    k    = min(neighbours, n)
+    ids  = np.arange(n)
+    own  = np.linalg.norm(xy - xy_mirrored, axis=1)
+    tree = scipy.spatial.cKDTree(xy_mirrored)
+    while True:
+        with instrument.stage("cost_matrix"):
+            dist, col = tree.query(xy, k)
+            dist, col = dist.ravel(), col.ravel()
+            row = np.repeat(ids, k)
+            # The costs are symmetric, so we keep the edges found from
+            # either side, each once.
+            edges, first = np.unique(np.concatenate([row*n + col, col*n + row, ids*n + ids]),
+                                     return_index=True)
+            cost   = np.concatenate([dist, dist, own])[first]
+            indptr = np.searchsorted(edges // n, np.arange(n + 1))
+        instrument.count("assignments")
+        instrument.size("assignment", (n, n))
+        with instrument.stage("assignment"):
+            match = midline.auction(indptr, edges % n, cost)[0]
+        paired = match != ids
+        if k == n or not paired.any():
+            return match
+        costs = np.linalg.norm(xy[match] - xy_mirrored, axis=1)
+        far   = np.count_nonzero(own[~paired] > costs[paired].max())
+        if far <= tolerance * n:
+            return match
+        instrument.count("widenings")
+        k = min(2*k, n)
+
+def left_right_ids (xy, match, normal=(1, 0)):
+    '''Split the matched pairs (id, match[id]) into left and right
+    ids, each pair being listed once. The left point of a pair is the
+    one lower along normal, the normal of the midline.
+
+    The assignments of stage_2 are permutations, and rarely
+    involutions: i may pair with j while j pairs with some k. The ids
+    are then visited in order, and each one not yet in a kept pair is
+    kept with its match. That loop is the usual path, and takes
+    milliseconds for thousands of points; only an involution takes
+    the vectorized path.'''
+    ids = np.arange(len(match))
+    if np.array_equal(match[match], ids):
+        # match is an involution: keep each pair from its smaller id.
+        ids = ids[ids <= match]
+    else:
+        taken, kept = np.zeros(len(match), bool), []
         for id in ids:
-            if (id not in left) and (id not in right):
-                if   x(id) < x(match[id]):
-                    left_id  = id
-                    right_id = match[id]
-                elif x(id) >= x(match[id]):
-                    left_id  = match[id]
-                    right_id = id
-                left.append(left_id)
-                right.append(right_id)
-        return (left, right)
-    left_ids, right_ids = compute_left_right_ids()
+            if not taken[id]:
+                taken[id] = taken[match[id]] = True
+                kept.append(id)
+        ids = np.array(kept, int)
+    left = xy[ids] @ normal < xy[match[ids]] @ normal
+    left_ids  = np.where(left, ids, match[ids])
+    right_ids = np.where(left, match[ids], ids)
+    return left_ids, right_ids
+
+@instrument.staged
+def stage_2 (session, neighbours=None, refine=None):
+    '''Pair each point with the point closest to its mirror image,
+    using the Hungarian algorithm on the full cost matrix. For large
+    sessions, set neighbours to only consider that many nearest mirror
+    images of each point and solve a sparse matching instead. With
+    refine, the midline x = x_mean then also shifts and tilts to fit
+    the pairs, alternating with pairing anew along it, for at most
+    refine steps (see midline.py).'''
+    xy_mirrored = mirrored(session)
+    if neighbours is None:
+        match = dense_match(session.xy, xy_mirrored)
+    else:
+        match = sparse_match(session.xy, xy_mirrored, neighbours)
+    normal = (1, 0)
+    if refine:
+        import midline
+        match, axis, _ = midline.refine(session.xy, match, midline.Axis(0.0, session.x_mean),
+                                        neighbours or 10, refine)
+        normal = axis.normal()
+    left_ids, right_ids = left_right_ids(session.xy, match, normal)
     assert len(left_ids)==len(right_ids), "Something is wrong."
     return left_ids, right_ids
 
-def stage_3 (left_ids, right_ids, dxdy, frames):
-    L, R = [], []
-    for frame in frames:
-        L.append(dxdy_frame_concat(dxdy, frame,  left_ids, False))
-        R.append(dxdy_frame_concat(dxdy, frame, right_ids, True))
+# Stage 3: (left_points, right_points) => (L, R)
+@instrument.staged
+def stage_3 (left_ids, right_ids, session):
+    '''Gather the Left Matrix L and the Right Matrix R from the
+    displacements of the session. Row `frame` of L is the
+    concatenation of `[dx, dy]` for all ids in `left_ids`; R is
+    likewise for `right_ids`, with each dx flipped. Displacements of
+    other dtypes (like the float32 of older session stores) are
+    widened to float64.'''
+    n = len(session.frames)
+    L = session.dxdy[:, np.asarray(left_ids)].astype(float, copy=False).reshape(n, -1)
+    R = session.dxdy[:, np.asarray(right_ids)].astype(float, copy=False).reshape(n, -1)
+    R[:, 0::2] *= -1
+    instrument.size("L", L.shape)
     return (L, R)
 
-# Computations
-[_xy, _dxdy, _ids, _frames, _x_mean] = stage_1()
-_left_ids, _right_ids                = stage_2(_xy, _dxdy, _ids, _frames, _x_mean)
-_L, _R                               = stage_3(_left_ids, _right_ids, _dxdy, _frames)
+def cli (argv=None):
+    '''stage_1 => T1 for one session, printing the p-value. Importing
+    this module does no work; everything happens here.'''
+    import argparse
+    parser = argparse.ArgumentParser(description="Test the asymmetry of a session.")
+    parser.add_argument("session", nargs="?", default="./data",
+                        help="a session directory or store (default: ./data)")
+    parser.add_argument("--neighbours", type=int, default=None,
+                        help="use the sparse matching of stage_2 with this many neighbours")
+    parser.add_argument("--motion", choices=["rigid", "similarity"], default=None,
+                        help="remove the head motion of each frame before the test")
+    parser.add_argument("--anchors", type=int, nargs="+", default=None,
+                        help="fit the head motion to these landmarks (columns of the raw data)")
+    parser.add_argument("--refine", type=int, default=None,
+                        help="refine the midline of stage_2 for at most this many steps")
+    parser.add_argument("--influence", action="store_true",
+                        help="also test without each frame, listing the most influential ones")
+    parser.add_argument("--k", type=int, nargs="+", default=None,
+                        help="test these spike orders at once, and estimate the order")
+    args = parser.parse_args(argv)
+    # Computations
+    session             = stage_1(args.session)
+    if args.motion:
+        anchors = None if args.anchors is None else np.flatnonzero(np.isin(session.old_ids, args.anchors))
+        session = remove_head_motion(session, args.motion == "similarity", anchors)
+    left_ids, right_ids = stage_2(session, args.neighbours, args.refine)
+    L, R                = stage_3(left_ids, right_ids, session)
+
+    # Result
+    if args.influence:
+        result    = stats.influence.leave_one_out(L, R)
+        influence = np.abs(result["T1_without"] - result["T1"])
+        print("p value is", result["p_value"])
+        # The rows of L are the frames of the session, which are not
+        # 0, .., m-1 when the loader left some out.
+        for row in sorted(set(result["flips"]) | set(np.argsort(influence)[::-1][:5])):
+            print("without frame {}: p value is {}{}".format(
+                session.frames[row], result["p_value_without"][row],
+                " (flips the decision)" if row in result["flips"] else ""))
+        return
+    if args.k is None:
+        report = stats.pca_asymmetry.asymmetry_report(L,R)
+        print("p value is", report["p_value"])
+        print("rate of asymmetry is", report["asymmetry_rate"])
+        return
+    result = stats.marietan_test.marietan_T1_test(L, R, args.k)
+    for k, p_value in zip(result["k"], result["p_value"]):
+        print("k = {}: p value is {}".format(k, p_value))
+    print("estimated k is {} (L) and {} (R)".format(result["k_hat_X"], result["k_hat_Y"]))
 
-# Result
-print("p value is", stats.marietan_test.marietan_T1_test(_L,_R))
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,239 @@
+# Refine the midline of stage_2 together with the pairing.
+#
+# stage_2 mirrors the points along the vertical line x = x_mean, the
+# plain mean of the x-coordinates, which is off whenever the points
+# are unevenly spread or the head is slightly turned. Here the axis
+# may also tilt: it is the line of unit normal n = (cos a, sin a) and
+# offset c, i.e. of the points z with n.z = c, and the mirror image
+# of z is M(z) = z - 2 (n.z - c) n. We alternate, like ICP, between
+#
+#   (1) fitting the axis to the current pairs (i, j = match[i]),
+#   (2) pairing anew along the fitted axis,
+#
+# until the pairs settle.
+#
+# (1) The pairing minimizes the sum of the distances |z_i - M(z_j)|.
+# For fixed pairs, a step of iteratively reweighted least squares,
+# with the weights w_i = 1/|z_i - M(z_j)| of the current axis, does
+# not increase that sum. With u = z_i - z_j and s = z_i + z_j,
+#
+#   |z_i - M(z_j)|^2 = |u|^2 - (n.u)^2 + (n.s - 2c)^2,
+#
+# so the weighted fit is c = n.s_mean/2, where s_mean is the weighted
+# mean of the s, and n is the eigenvector of the least eigenvalue of
+# the 2 x 2 matrix sum_i w_i ((s - s_mean)(s - s_mean)^t - u u^t).
+#
+# (2) Once the axis moves little, most pairs stay put, so instead of
+# a new dense assignment we solve a sparse one, like sparse_match in
+# main.py, over the `neighbours` nearest mirror images of each point
+# and the current pairs (which keep a full matching at hand), with an
+# auction algorithm [1]. Each object j has a price p_j, and a point
+# i picks the object minimizing c_ij + p_j. Unpaired points bid for
+# their best object, raising its price by the margin over their
+# second best plus eps, and each object goes to its highest bidder.
+# The result is within eps per point of the optimum, and eps is
+# scaled down step by step, each step unpairing the points whose pair
+# is no longer within eps of their best. The pairs and prices of the
+# previous iteration are kept, and eps starts from the largest slack
+# they leave, so a refined axis only costs the bids of the pairs that
+# actually move. The KD-tree of the points is also built once: as M
+# is an isometry and an involution, |z_i - M(z_j)| is the distance
+# from z_j to M(z_i).
+#
+# [1] Bertsekas, D. P. (1988). The auction algorithm: a distributed
+# relaxation method for the assignment problem. Annals of Operations
+# Research, 14(1), 105-123.
+
+# global modules
+import numpy as np
+from typing import NamedTuple
+# local modules
+import instrument
+
+# The number of unpaired points below which the auction bids one by
+# one (see _bid_one_by_one).
+TAIL = 64
+
+class Axis (NamedTuple):
+    '''The line of the points (x, y) with cos(angle) x + sin(angle) y
+    = offset. The axis x = x_mean of stage_2 is Axis(0, x_mean).'''
+    angle  : float
+    offset : float
+
+    def normal (self):
+        return np.array([np.cos(self.angle), np.sin(self.angle)])
+
+def reflect (xy, axis):
+    '''The mirror images of the points xy along axis.'''
+    n = axis.normal()
+    return xy - 2*(xy @ n - axis.offset)[:, None] * n
+
+def fit_axis (xy, match, axis):
+    '''The axis of the pairs (id, match[id]) after one reweighted
+    least squares step from axis (see (1) above).'''
+    u, s = xy - xy[match], xy + xy[match]
+    r    = np.linalg.norm(xy - reflect(xy[match], axis), axis=1)
+    w    = 1 / np.maximum(r, 1e-9 * (1 + r.max()))
+    s_w  = w @ s / w.sum()
+    A    = (s - s_w).T @ (w[:, None] * (s - s_w)) - u.T @ (w[:, None] * u)
+    n    = np.linalg.eigh(A)[1][:, 0]
+    n    = n if n[0] >= 0 else -n
+    return Axis(float(np.arctan2(n[1], n[0])), float(s_w @ n) / 2)
+
+def candidates (tree, xy, axis, neighbours, match):
+    '''The sparse cost matrix as (indptr, cols, costs), row i holding
+    the `neighbours` nearest mirror images of i, the points to which i
+    is such a neighbour, and match[i].'''
+    n = len(xy)
+    k = min(neighbours, n)
+    dist, col = tree.query(reflect(xy, axis), k)
+    ids       = np.arange(n)
+    row       = np.repeat(ids, k)
+    col       = col.ravel()
+    partner   = np.linalg.norm(xy - reflect(xy[match], axis), axis=1)
+    edges, first = np.unique(np.concatenate([row*n + col, col*n + row, ids*n + match, match*n + ids]),
+                             return_index=True)
+    costs  = np.concatenate([dist.ravel(), dist.ravel(), partner, partner])[first]
+    indptr = np.searchsorted(edges // n, np.arange(n + 1))
+    return indptr, edges % n, costs
+
+def auction (indptr, cols, costs, match=None, prices=None, eps=None, start=None):
+    '''A minimum cost full matching of the sparse cost matrix, given
+    as (indptr, cols, costs) with cols sorted within each row and a
+    full matching among its entries, warm started from match and
+    prices if given. Returns the match and the prices. Its total cost
+    is within len(match) * eps of the optimum; eps defaults to 1e-9 of
+    the largest cost, and is scaled down from start, which defaults to
+    a quarter of the largest cost, or with prices, to the largest
+    slack of the pairs.'''
+    n      = len(indptr) - 1
+    rows   = np.repeat(np.arange(n), np.diff(indptr))
+    keys   = rows*n + cols
+    top    = float(costs.max()) or 1.0
+    eps    = eps or 1e-9 * top
+    step   = start or (top / 4 if prices is None else None)
+    prices = np.zeros(n) if prices is None else prices.copy()
+    owner  = np.full(n, -1)
+    if match is None:
+        match = np.full(n, -1)
+    else:
+        match = match.copy()
+        owner[match] = np.arange(n)
+    bids   = 0
+    while True:
+        # Unpair the points whose pair is not within step of their best.
+        paired = np.flatnonzero(match >= 0)
+        value  = costs + prices[cols]
+        best   = np.minimum.reduceat(value, indptr[:-1])
+        slack  = value[np.searchsorted(keys, paired*n + match[paired])] - best[paired]
+        step   = step or max(slack.max(initial=0), eps)
+        loose  = paired[slack > step]
+        owner[match[loose]], match[loose] = -1, -1
+        bids  += _bid(indptr, cols, costs, match, owner, prices, step, top)
+        if step <= eps:
+            break
+        step = max(step / 8, eps)
+    instrument.count("auction_bids", bids)
+    return match, prices
+
+def _bid (indptr, cols, costs, match, owner, prices, step, top):
+    '''Run the rounds of bids at increment step until every point is
+    paired, updating match, owner and prices in place. Returns the
+    number of bids.'''
+    bids = 0
+    while (free := np.flatnonzero(match < 0)).size > TAIL:
+        bids   += free.size
+        lens    = indptr[free + 1] - indptr[free]
+        ends    = np.cumsum(lens)
+        starts  = ends - lens
+        entries = np.repeat(indptr[free] - starts, lens) + np.arange(ends[-1])
+        value   = costs[entries] + prices[cols[entries]]
+        first   = np.minimum.reduceat(value, starts)
+        chosen  = np.minimum.reduceat(np.where(value == np.repeat(first, lens),
+                                               np.arange(ends[-1]), ends[-1]), starts)
+        value[chosen] = np.inf
+        second  = np.minimum.reduceat(value, starts)
+        second  = np.where(np.isfinite(second), second, first + top)
+        objects = cols[entries[chosen]]
+        offers  = prices[objects] + (second - first) + step
+        # Each object goes to its highest bidder.
+        order   = np.lexsort((-offers, objects))
+        _, won  = np.unique(objects[order], return_index=True)
+        won     = order[won]
+        objects = objects[won]
+        losers  = owner[objects]
+        match[losers[losers >= 0]] = -1
+        owner[objects]   = free[won]
+        match[free[won]] = objects
+        prices[objects]  = offers[won]
+    if free.size:
+        bids += _bid_one_by_one(indptr, cols, costs, match, owner, prices, step, top, free)
+    return bids
+
+def _bid_one_by_one (indptr, cols, costs, match, owner, prices, step, top, free):
+    '''Like _bid, one bid at a time. The last few unpaired points
+    often displace each other in long chains, which costs a round of
+    _bid per bid, so this is faster once they are few.'''
+    indptr, cols, costs = indptr.tolist(), cols.tolist(), costs.tolist()
+    price, free, bids   = prices.tolist(), free.tolist(), 0
+    while free:
+        i = free.pop()
+        bids += 1
+        first = second = np.inf
+        for e in range(indptr[i], indptr[i+1]):
+            value = costs[e] + price[cols[e]]
+            if value < first:
+                first, second, chosen = value, first, cols[e]
+            elif value < second:
+                second = value
+        if second == np.inf:
+            second = first + top
+        price[chosen] += second - first + step
+        loser = owner[chosen]
+        if loser >= 0:
+            match[loser] = -1
+            free.append(int(loser))
+        owner[chosen], match[i] = i, chosen
+    prices[:] = price
+    return bids
+
+def cost (xy, match, axis):
+    '''The total distance from the points to the mirror images of
+    their pairs.'''
+    return float(np.linalg.norm(xy - reflect(xy[match], axis), axis=1).sum())
+
+def refine (xy, match, axis, neighbours=10, iterations=10, tol=1e-6):
+    '''Alternate between fitting the axis to the pairs (id, match[id])
+    and pairing the points xy along it, starting from axis, until the
+    total distance (see cost) improves by less than tol relatively, or
+    after `iterations` steps. Returns the match and the axis of the
+    least total distance seen, the given ones included, and the
+    number of steps taken.'''
+    import scipy.spatial
+    tree   = scipy.spatial.cKDTree(xy)
+    prices = None
+    before = cost(xy, match, axis)
+    best   = (before, match, axis)
+    for step in range(1, iterations + 1):
+        fitted = fit_axis(xy, match, axis)
+        # No cost changes by more than the mirror images move, so the
+        # pairs of the last step are still within about twice that
+        # of their best.
+        start  = 2 * np.linalg.norm(reflect(xy, fitted) - reflect(xy, axis), axis=1).max()
+        axis   = fitted
+        with instrument.stage("auction"):
+            new, prices = auction(*candidates(tree, xy, axis, neighbours, match),
+                                  match, prices, start=start if prices is not None else None)
+        instrument.count("moved_pairs", int(np.count_nonzero(new != match)))
+        match, after = new, cost(xy, new, axis)
+        if after < best[0]:
+            best = (after, match, axis)
+        # Points sharing a location may still swap partners, so the
+        # pairs count as settled once the distance stops improving.
+        # A step may also make the distance worse, and then the best
+        # pairs seen so far are kept.
+        if before - after <= tol * before:
+            break
+        before = after
+    _, match, axis = best
+    return match, axis, step
@@ -0,0 +1,178 @@
+# Usage :: Replay a session frame by frame, e.g.
+#
+#   python online.py ./data/ --window 500
+#
+# Update the asymmetry test as the frames of a session arrive from
+# the tracker, rather than rerunning stage_1 => T1 on the whole
+# recording each time.
+#
+# The pairing of stage_2 only depends on the locations, so it is
+# found once, on the first frame, and kept. Each frame then adds one
+# row to L and one to R (see stage_3). The test only needs the
+# eigenvalues of hat_Sigma of the centralized L and R, i.e. of their
+# Gram matrices K = X_c X_c^t (divided by n), where the rows of X_c
+# are the rows of X minus their mean mu. Let d = x - mu for a new
+# row x. Then the new mean is mu + d/(n+1), and with c = X_c d,
+#
+#   K[i,j] <- K[i,j] - (c_i + c_j)/(n+1) + |d|^2/(n+1)^2,
+#
+# where K is first bordered by the row c (and |d|^2 on the diagonal)
+# for the new row. A frame thus costs O(n p) for c, O(n^2) for the
+# update and an n x n eigvalsh, instead of the O(n^2 p) of forming
+# the Gram matrix anew. Dropping the oldest row e = x_0 - mu is the
+# same update backwards, with c replaced by the column K[:, 0] that
+# is already at hand, so with a window of the last W frames the cost
+# per frame stays flat, whatever the length of the recording.
+#
+# Once there are more frames n than coordinates p, we rather keep the
+# p x p scatter matrix S = X_c^t X_c, which has the same nonzero
+# eigenvalues (see stats/marietan_test.py). A new row adds n/(n+1) d
+# d^t to it and dropping a row subtracts n/(n-1) e e^t, so a frame
+# costs O(p^2) and a p x p eigvalsh.
+
+# global modules
+import time
+import argparse
+import numpy as np
+# local modules
+import main
+import instrument
+import stats.marietan_test as mt
+
+class OnlineSession:
+    '''A session whose frames arrive one by one. It is created from
+    the first frame, as rows of the raw arrays of stage_1 (pointi of
+    shape (2*points,), dest_x and dest_y of shape (points,)). Each
+    call of append adds a frame and returns the updated test of spike
+    order k. With a window, only the last `window` frames are
+    tested.
+
+    Only a window keeps the cost of a frame flat. Without one, each
+    frame costs an eigvalsh of size min(n, p) for the n frames so
+    far, i.e. O(min(n, p)^3), which grows with the recording until n
+    reaches the p coordinates of L.'''
+    def __init__ (self, pointi, dest_x, dest_y, neighbours=None, window=None,
+                  k=mt.SPIKE_ORDER):
+        first        = main.cleanse(pointi[None], dest_x[None], dest_y[None])
+        self.old_ids = first.old_ids
+        self.left_ids, self.right_ids = main.stage_2(first, neighbours)
+        assert window is None or window >= 2, "The window must hold 2 frames."
+        self.window  = window
+        self.k       = k
+        self.p       = 2 * len(self.left_ids)
+        self.n       = 0
+        self.rows    = np.empty((2, 16, self.p))     # the raw rows of L and R
+        self.mean    = np.zeros((2, self.p))
+        self.gram    = np.zeros((2, 0, 0))           # K, while n <= p
+        self.scatter = None                          # S, once n > p
+        self.first   = first
+        self.append(dest_x, dest_y)
+
+    def _rows (self, dest_x, dest_y):
+        '''The rows of L and R for one frame, as in stage_3.'''
+        dxdy  = np.stack([dest_x[self.old_ids], dest_y[self.old_ids]], axis=1)[None]
+        frame = self.first._replace(dxdy=np.nan_to_num(dxdy, nan=0), frames=range(0, 1),
+                                    valid=~np.isnan(dxdy).any(axis=2))
+        return np.concatenate(main.stage_3(self.left_ids, self.right_ids, frame))
+
+    def _add (self, z):
+        n, d = self.n, z - self.mean
+        dd   = np.einsum("sp,sp->s", d, d)
+        if self.scatter is None:
+            c = np.einsum("snp,sp->sn", self.rows[:, :n], d) - np.einsum("sp,sp->s", self.mean, d)[:, None]
+            c = np.concatenate([c, dd[:, None]], axis=1)
+            K = np.empty((2, n+1, n+1))
+            K[:, :n, :n] = self.gram
+            K[:, n, :] = K[:, :, n] = c
+            self.gram = K - (c[:, :, None] + c[:, None, :])/(n+1) + (dd/(n+1)**2)[:, None, None]
+        else:
+            self.scatter += n/(n+1) * d[:, :, None] * d[:, None, :]
+        self.mean += d/(n+1)
+        if n == self.rows.shape[1]:
+            self.rows = np.concatenate([self.rows, np.empty_like(self.rows)], axis=1)
+        self.rows[:, n] = z
+        self.n = n + 1
+        if self.scatter is None and self.n > self.p:
+            X_c = self.rows[:, :self.n] - self.mean[:, None]
+            self.scatter = np.swapaxes(X_c, -1, -2) @ X_c
+            self.gram    = None
+
+    def _remove (self):
+        '''Drop the oldest row.'''
+        n = self.n
+        e = self.rows[:, 0] - self.mean
+        if self.scatter is None:
+            g  = self.gram[:, :, 0]
+            ee = self.gram[:, 0, 0]
+            K  = self.gram + (g[:, :, None] + g[:, None, :])/(n-1) + (ee/(n-1)**2)[:, None, None]
+            self.gram = K[:, 1:, 1:]
+        else:
+            self.scatter -= n/(n-1) * e[:, :, None] * e[:, None, :]
+        self.mean -= e/(n-1)
+        self.rows[:, :n-1] = self.rows[:, 1:n]
+        self.n = n - 1
+
+    def refresh (self):
+        '''Recompute the Gram or scatter matrices from the rows, which
+        clears the rounding errors accumulated by the updates.'''
+        self.mean = self.rows[:, :self.n].mean(axis=1)
+        X_c       = self.rows[:, :self.n] - self.mean[:, None]
+        if self.scatter is None:
+            self.gram = X_c @ np.swapaxes(X_c, -1, -2)
+        else:
+            self.scatter = np.swapaxes(X_c, -1, -2) @ X_c
+
+    def spectra (self):
+        '''The spectra of hat_Sigma of the centralized L and R.'''
+        n = self.n
+        instrument.count("eigendecompositions", 2)
+        if self.scatter is None:
+            instrument.size("eigendecomposition", (n, n))
+            eigvals = np.linalg.eigvalsh(self.gram)[:, ::-1] / n
+        else:
+            instrument.size("eigendecomposition", (self.p, self.p))
+            eigvals = np.linalg.eigvalsh(self.scatter)[:, ::-1] / n
+            eigvals = np.concatenate([eigvals, np.zeros((2, n - self.p))], axis=1)
+        return mt.Spectrum(eigvals[0]), mt.Spectrum(eigvals[1])
+
+    def append (self, dest_x, dest_y):
+        '''Add the frame of displacements dest_x, dest_y, and return
+        the record of the updated test. T1 needs at least k + 2
+        frames; before that, T1 and the p-value are NaN.'''
+        start = time.perf_counter()
+        self._add(self._rows(dest_x, dest_y))
+        if self.window is not None and self.n > self.window:
+            self._remove()
+        if self.n < self.k + 2:
+            T1 = np.nan
+        else:
+            T1 = float(mt.T_1_of_spectra(*self.spectra(), self.n, self.k))
+        return {"frames" : self.n,
+                "T1"     : T1,
+                "p_value": float(mt.chi2_p_value(T1, self.k)),
+                "seconds": time.perf_counter() - start}
+
+def replay (directory, neighbours=None, window=None):
+    '''Feed the frames of the session in directory (holding
+    `pointi.npy`, `dest_x.npy` and `dest_y.npy`) one by one to an
+    OnlineSession, yielding the records.'''
+    pointi = np.load(directory + "/pointi.npy")
+    dest_x = np.load(directory + "/dest_x.npy")
+    dest_y = np.load(directory + "/dest_y.npy")
+    online = OnlineSession(pointi[0], dest_x[0], dest_y[0], neighbours, window)
+    for frame in range(1, len(pointi)):
+        yield online.append(dest_x[frame], dest_y[frame])
+
+def cli (argv=None):
+    parser = argparse.ArgumentParser(description="Replay a session frame by frame.")
+    parser.add_argument("session", help="a session directory")
+    parser.add_argument("--neighbours", type=int, default=None,
+                        help="use the sparse matching of stage_2 with this many neighbours")
+    parser.add_argument("--window", type=int, default=None,
+                        help="only test the last this many frames, which keeps the cost per frame flat")
+    args = parser.parse_args(argv)
+    for record in replay(args.session, args.neighbours, args.window):
+        print("{frames:>6} frames  T1 {T1:10.4f}  p {p_value:.4f}  {seconds:.4f} s".format(**record))
+
+if __name__ == "__main__":
+    cli()
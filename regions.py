@@ -0,0 +1,138 @@
+# Usage :: Test the asymmetry of each region of the face, e.g.
+#
+#   python regions.py ./data/ regions.json
+#
+# where regions.json maps each region name either to a polygon, a
+# list of [x, y] vertices in the coordinates of stage_1, or to a list
+# of landmarks, i.e. of columns of the raw data (see
+# Session.old_ids).
+#
+# A pair of stage_2 belongs to a region if its left or its right
+# point does, and the L and R of a region are the columns of the
+# whole-face L and R (stage_3) of its pairs. Centralizing commutes
+# with taking columns, so L and R are gathered and centralized once.
+# As the frames are usually fewer than the coordinates, the spectrum
+# of a region comes from its Gram matrix
+#
+#   K_r = X_r X_r^t = \sum_{pairs j in r} X_j X_j^t,
+#
+# which is a sum over its pairs. We split the pairs into atoms, the
+# sets of pairs belonging to exactly the same regions, form the Gram
+# matrix of each atom once, and add up the atoms of each region. So
+# overlapping or nested regions share their contributions, and the
+# Gram matrices of all the regions cost one pass over the columns.
+# All the spectra are then found by one stacked eigvalsh, and all the
+# T1 by one call of T_1_of_spectra. A region with fewer coordinates
+# than frames is rather decomposed in the dual form, like in
+# stats/marietan_test.py.
+
+# global modules
+import json
+import warnings
+import argparse
+import numpy as np
+# local modules
+import main
+import instrument
+import stats.marietan_test as mt
+
+def inside (xy, polygon):
+    '''The ids of the points xy that lie inside polygon, an array of
+    its vertices (ray casting, vectorized over points and edges).'''
+    x, y   = xy[:, 0, None], xy[:, 1, None]
+    x0, y0 = np.asarray(polygon, dtype=float).T
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crosses = ((y0 > y) != (y1 > y)) & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+    return np.flatnonzero(crosses.sum(axis=1) % 2 == 1)
+
+def polygon_regions (session, polygons):
+    '''The ids in each polygon, given as {name: vertices}.'''
+    return {name: inside(session.xy, polygon) for name, polygon in polygons.items()}
+
+def landmark_regions (session, landmarks):
+    '''The ids of each region given as {name: columns of the raw
+    data}. Landmarks missing from the session are left out.'''
+    return {name: np.flatnonzero(np.isin(session.old_ids, columns))
+            for name, columns in landmarks.items()}
+
+def membership (left_ids, right_ids, regions, points):
+    '''The boolean matrix (pairs, regions) telling which pairs belong
+    to which regions, given as {name: ids} among the ids 0, ..,
+    points-1. Unpaired ids in a region are ignored.'''
+    n = points
+    B = np.zeros((len(left_ids), len(regions)), dtype=bool)
+    for r, ids in enumerate(regions.values()):
+        member = np.zeros(n, dtype=bool)
+        member[np.asarray(ids, dtype=int)] = True
+        B[:, r] = member[left_ids] | member[right_ids]
+    return B
+
+def region_spectra (Z, B):
+    '''The spectra of hat_Sigma of the columns of each region, for a
+    stack Z of centralized samples of shape (..., m, 2*pairs) and the
+    membership matrix B. The eigenvalues have shape (regions, ...,
+    m).'''
+    m       = Z.shape[-2]
+    columns = lambda pairs: np.stack([2*pairs, 2*pairs + 1], axis=1).ravel()
+    counts  = 2 * B.sum(axis=0)
+    primal  = counts >= m
+    eigvals = np.zeros((B.shape[1],) + Z.shape[:-1])
+    if primal.any():
+        # The atoms of the regions decomposed in the primal form.
+        atoms, atom_of = np.unique(B[:, primal], axis=0, return_inverse=True)
+        K = np.zeros((int(primal.sum()),) + Z.shape[:-1] + (m,))
+        for a, atom in enumerate(atoms):
+            if atom.any():
+                Z_a = Z[..., columns(np.flatnonzero(atom_of.ravel() == a))]
+                K[atom] += Z_a @ np.swapaxes(Z_a, -1, -2)
+        instrument.count("eigendecompositions", int(np.prod(K.shape[:-2])))
+        instrument.size("eigendecomposition", (m, m))
+        eigvals[primal] = np.linalg.eigvalsh(K / m)[..., ::-1]
+    for r in np.flatnonzero(~primal):
+        eigvals[r] = mt.spectrum(Z[..., columns(np.flatnonzero(B[:, r]))]).eigvals
+    return eigvals
+
+def region_T1_test (session, left_ids, right_ids, regions, k=mt.SPIKE_ORDER):
+    '''The T1 test of each region given as {name: ids}, in one pass.
+    Returns {name: record}, each record holding the number of pairs
+    of the region, T1 and the p-value. Regions too small for the spike
+    order k get NaN.'''
+    L, R   = main.stage_3(left_ids, right_ids, session)
+    Z      = mt.centralize(np.stack([L, R]))
+    m      = Z.shape[-2]
+    B      = membership(left_ids, right_ids, regions, len(session.xy))
+    pairs  = B.sum(axis=0)
+    valid  = np.minimum(m - 1, 2*pairs) > k
+    for name in np.array(list(regions), dtype=object)[~valid]:
+        warnings.warn("region {} has too few pairs or frames for T1.".format(name))
+    T1 = np.full(len(regions), np.nan)
+    if valid.any():
+        eigvals   = region_spectra(Z, B[:, valid])
+        T1[valid] = mt.T_1_of_spectra(mt.Spectrum(eigvals[:, 0]), mt.Spectrum(eigvals[:, 1]), m, k)
+    p_values = mt.chi2_p_value(T1, k)
+    return {name: {"pairs": int(pairs[r]), "T1": float(T1[r]), "p_value": float(p_values[r])}
+            for r, name in enumerate(regions)}
+
+def cli (argv=None):
+    parser = argparse.ArgumentParser(description="Test the asymmetry of each region of the face.")
+    parser.add_argument("session", help="a session directory or store")
+    parser.add_argument("regions", help="a JSON file mapping names to polygons or landmarks")
+    parser.add_argument("--neighbours", type=int, default=None,
+                        help="use the sparse matching of stage_2 with this many neighbours")
+    args = parser.parse_args(argv)
+    with open(args.regions) as file:
+        given = json.load(file)
+    session = main.stage_1(args.session)
+    regions = {}
+    for name, value in given.items():
+        if len(value) and np.ndim(value[0]) == 1:
+            regions.update(polygon_regions(session, {name: value}))
+        else:
+            regions.update(landmark_regions(session, {name: value}))
+    left_ids, right_ids = main.stage_2(session, args.neighbours)
+    for name, record in region_T1_test(session, left_ids, right_ids, regions).items():
+        print(json.dumps(dict({"region": name}, **record)))
+
+if __name__ == "__main__":
+    cli()
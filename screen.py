@@ -0,0 +1,115 @@
+# Usage :: Screen a session on a coarse grid before the full test, e.g.
+#
+#   python screen.py ./data/ --band 0.01 0.25 --cells 32
+#   python batch.py ./cohort/ --screen 0.01 0.25 > results.jsonl
+#
+# Most sessions are clearly symmetric or clearly not, and do not need
+# the dense assignment of stage_2 and the full width T1-test to tell.
+# Screening first pools the displacements of stage_1 onto a coarse
+# grid of square cells, laid out symmetrically around the line
+# x = x_mean of stage_2: the column c of cells, counted from that
+# line (c < 0 on the left), mirrors the column -1-c, so the cells
+# pair up without any assignment. The displacement of a cell in a
+# frame is the mean displacement of its points, and the L and R of
+# the cell pairs are gathered like in stage_3, each dx of R flipped.
+#
+# The T1-test of these small matrices gives a coarse p-value. Only if
+# it falls inside the uncertainty band [low, high] (or the grid has
+# too few cell pairs for the test) does the session go through the
+# full pipeline. The record tells which path gave its p-value, as
+# "path": "coarse" or "full", and always holds the coarse p-value, so
+# running a cohort once with the band [0, 1], which escalates every
+# session, shows how often each band would have agreed with the full
+# test, and at which cost.
+
+# global modules
+import json
+import argparse
+import numpy as np
+# local modules
+import main
+import instrument
+import stats.marietan_test as mt
+
+def grid_cells (session, cells=32):
+    '''The cell (row, column) of each point on the grid of cells
+    columns across the face (rounded down to an even number), the
+    columns counted from the line x = x_mean. Returns two arrays of
+    shape (points,).'''
+    half   = max(cells // 2, 1)
+    x, y   = session.xy[:, 0] - session.x_mean, session.xy[:, 1]
+    size   = max(np.abs(x).max(), 1e-9) / half
+    column = np.clip(np.floor(x / size), -half, half - 1).astype(int)
+    row    = np.floor((y - y.min()) / size).astype(int)
+    return row, column
+
+@instrument.staged
+def coarse_matrices (session, cells=32):
+    '''The L and R of the pairs of mirrored cells of the grid (see
+    grid_cells), of shape (frames, 2*pairs), holding the mean
+    displacement of the points of each cell.'''
+    row, column = grid_cells(session, cells)
+    width       = cells + 2
+    keys        = row * width + column + width//2
+    # The mean displacement of each non empty cell, in one pass.
+    order       = np.argsort(keys, kind="stable")
+    cell, first, counts = np.unique(keys[order], return_index=True, return_counts=True)
+    pooled      = np.add.reduceat(session.dxdy[:, order], first, axis=1) / counts[:, None]
+    # The column c of a cell mirrors the column -1-c.
+    row, column = cell // width, cell % width - width//2
+    left        = np.flatnonzero(column < 0)
+    mirror      = row[left] * width + (-1 - column[left]) + width//2
+    found       = np.minimum(np.searchsorted(cell, mirror), len(cell) - 1)
+    paired      = cell[found] == mirror
+    left_cells, right_cells = left[paired], found[paired]
+    n = len(session.frames)
+    L = pooled[:, left_cells].astype(float, copy=False).reshape(n, -1)
+    R = pooled[:, right_cells].astype(float, copy=False).reshape(n, -1)
+    R[:, 0::2] *= -1
+    instrument.size("coarse L", L.shape)
+    return L, R
+
+def full_test (session, neighbours=None, k=mt.SPIKE_ORDER):
+    '''The record of the full pipeline, stage_2 => T1, of session.'''
+    left_ids, right_ids = main.stage_2(session, neighbours)
+    L, R                = main.stage_3(left_ids, right_ids, session)
+    return {"pairs": len(left_ids), "p_value": float(mt.marietan_T1_test(L, R, k))}
+
+def screen_session (session, band=(0.01, 0.25), cells=32, neighbours=None, full=None,
+                    k=mt.SPIKE_ORDER):
+    '''The p-value of session, from the coarse grid of cells columns
+    if its p-value falls outside band, and otherwise from the full
+    pipeline, which is full_test unless another function of the
+    session returning a record is given as full. Returns a record
+    holding "path", "p_value", "coarse_p_value" and "cell_pairs",
+    updated by the record of the full pipeline if it ran.'''
+    L, R   = coarse_matrices(session, cells)
+    pairs  = L.shape[1] // 2
+    coarse = float("nan")
+    if min(len(L) - 1, 2*pairs) > k:
+        coarse = float(mt.marietan_T1_test(L, R, k))
+    record = {"path"          : "coarse",
+              "frames"        : len(session.frames),
+              "points"        : len(session.xy),
+              "cell_pairs"    : pairs,
+              "coarse_p_value": coarse,
+              "p_value"       : coarse}
+    if np.isnan(coarse) or band[0] <= coarse <= band[1]:
+        record.update(full(session) if full else full_test(session, neighbours, k), path="full")
+    return record
+
+def cli (argv=None):
+    parser = argparse.ArgumentParser(description="Screen a session on a coarse grid before the full test.")
+    parser.add_argument("session", help="a session directory or store")
+    parser.add_argument("--band", type=float, nargs=2, default=[0.01, 0.25],
+                        help="run the full test when the coarse p-value is in this band (default: 0.01 0.25)")
+    parser.add_argument("--cells", type=int, default=32,
+                        help="number of grid cells across the face (default: 32)")
+    parser.add_argument("--neighbours", type=int, default=None,
+                        help="use the sparse matching of stage_2 with this many neighbours")
+    args = parser.parse_args(argv)
+    session = main.stage_1(args.session)
+    print(json.dumps(screen_session(session, args.band, args.cells, args.neighbours)))
+
+if __name__ == "__main__":
+    cli()
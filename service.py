@@ -0,0 +1,292 @@
+# Usage :: Serve the pipeline from a warm process on this machine, e.g.
+#
+#   python service.py --port 8765 --workers 4
+#   python service.py --socket /tmp/asymmetry.sock
+#
+# The service only listens on 127.0.0.1 (or on a Unix socket). Its
+# worker processes import NumPy and SciPy once, when the service
+# starts, so a job only pays for the stages themselves. The requests
+# and responses are JSON:
+#
+#   POST   /jobs          submit {"session": path, "neighbours": k};
+#                         an `.npz` body holding pointi, dest_x and
+#                         dest_y (as for stage_1) is also accepted,
+#                         with ?neighbours=k in the query
+#   GET    /jobs/<id>     the status of a job, and its record (see
+#                         batch.py) once it has finished
+#   DELETE /jobs/<id>     cancel a job
+#   GET    /health        whether the service is up, and its load
+#   GET    /metrics       jobs per status and latencies
+#
+# With ?wait=1, POST /jobs and GET /jobs/<id> only answer once the
+# job has finished. At most --workers jobs run at once, and at most
+# --queue wait; beyond that, POST /jobs answers 503. A queued job
+# that is cancelled never runs. A running job cannot be interrupted,
+# so its worker finishes it and the record is dropped.
+#
+#   curl -s -X POST 'localhost:8765/jobs?wait=1' -d '{"session": "./data"}'
+
+# global modules
+import io
+import os
+import json
+import time
+import signal
+import asyncio
+import argparse
+import itertools
+import collections
+import urllib.parse
+import multiprocessing
+import concurrent.futures
+import numpy as np
+# local modules
+import main
+import batch
+
+MAX_BODY = 1 << 30
+REASONS  = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found",
+            405: "Method Not Allowed", 413: "Payload Too Large",
+            503: "Service Unavailable"}
+
+def warm ():
+    '''Import everything the stages load lazily.'''
+    import scipy.optimize
+    import scipy.sparse.csgraph
+    import scipy.spatial.distance
+    import scipy.special
+
+def run_job (spec):
+    '''The record of the job spec, in a worker process.'''
+    if "session" in spec:
+        return batch.run_session(spec["session"], spec.get("neighbours"))
+    start = time.perf_counter()
+    try:
+        session = main.cleanse(spec["pointi"], spec["dest_x"], spec["dest_y"])
+        record  = dict({"session": None}, **batch.test_session(session, spec.get("neighbours")))
+    except Exception as error:
+        record = {"session": None,
+                  "error"  : "{}: {}".format(type(error).__name__, error)}
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+def quantiles (values, qs=(0.5, 0.95, 1.0)):
+    if not values:
+        return {}
+    return dict(zip(["p50", "p95", "max"], np.quantile(values, qs).tolist()))
+
+class Service:
+    '''The jobs, the queue and the worker pool. A job is a dict
+    holding its id, status, spec, times and record; the last `keep`
+    finished jobs are kept for GET /jobs/<id>.'''
+    def __init__ (self, workers=None, queue=64, keep=1000):
+        self.workers   = workers or os.cpu_count()
+        self.size      = queue
+        self.keep      = keep
+        self.jobs      = collections.OrderedDict()
+        self.ids       = itertools.count(1)
+        self.counts    = collections.Counter()
+        self.latencies = collections.deque(maxlen=1000)
+        self.running   = 0
+        self.started   = time.time()
+
+    async def start (self):
+        context    = multiprocessing.get_context("spawn")
+        self.pool  = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=context, initializer=warm)
+        self.queue = asyncio.Queue(self.size)
+        loop       = asyncio.get_running_loop()
+        # Start the workers now rather than on the first job.
+        await asyncio.gather(*[loop.run_in_executor(self.pool, warm)
+                               for _ in range(self.workers)])
+        self.consumers = [asyncio.create_task(self.consume())
+                          for _ in range(self.workers)]
+
+    def stop (self):
+        for consumer in self.consumers:
+            consumer.cancel()
+        self.pool.shutdown(cancel_futures=True)
+
+    async def consume (self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            if job["status"] != "queued":
+                continue
+            job["status"], job["started"] = "running", time.time()
+            self.running += 1
+            try:
+                record = await loop.run_in_executor(self.pool, run_job, job.pop("spec"))
+            except Exception as error:
+                record = {"error": "{}: {}".format(type(error).__name__, error)}
+            finally:
+                self.running -= 1
+            if job["status"] == "running":
+                self.finish(job, "failed" if "error" in record else "done", record)
+
+    def finish (self, job, status, record=None):
+        job["status"], job["finished"], job["record"] = status, time.time(), record
+        job["done"].set()
+        self.counts[status] += 1
+        if status != "cancelled":
+            self.latencies.append(job["finished"] - job["submitted"])
+        finished = [id for id, j in self.jobs.items() if j["done"].is_set()]
+        for id in finished[:max(0, len(finished) - self.keep)]:
+            del self.jobs[id]
+
+    def submit (self, spec):
+        if self.queue.full():
+            self.counts["rejected"] += 1
+            return None
+        job = {"id"       : next(self.ids),
+               "status"   : "queued",
+               "spec"     : spec,
+               "submitted": time.time(),
+               "done"     : asyncio.Event()}
+        self.queue.put_nowait(job)
+        self.jobs[job["id"]] = job
+        self.counts["submitted"] += 1
+        return job
+
+    def cancel (self, job):
+        if not job["done"].is_set():
+            job.pop("spec", None)
+            self.finish(job, "cancelled")
+
+    def view (self, job):
+        result = {"id": job["id"], "status": job["status"]}
+        if "started" in job:
+            result["queued_seconds"] = job["started"] - job["submitted"]
+        if job.get("record") is not None:
+            result["record"] = job["record"]
+        return result
+
+    def health (self):
+        return {"status"        : "ok",
+                "workers"       : self.workers,
+                "running"       : self.running,
+                "queued"        : self.queue.qsize(),
+                "uptime_seconds": time.time() - self.started}
+
+    def metrics (self):
+        return dict(self.health(),
+                    jobs           = dict(self.counts),
+                    latency_seconds= quantiles(list(self.latencies)))
+
+    async def route (self, method, target, headers, body):
+        url   = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        wait  = query.get("wait") in ("1", "true")
+        parts = url.path.strip("/").split("/")
+        if parts == ["health"] and method == "GET":
+            return 200, self.health()
+        if parts == ["metrics"] and method == "GET":
+            return 200, self.metrics()
+        if parts == ["jobs"] and method == "POST":
+            if headers.get("content-type") == "application/octet-stream":
+                arrays = np.load(io.BytesIO(body), allow_pickle=False)
+                if not isinstance(arrays, np.lib.npyio.NpzFile):
+                    return 400, {"error": "expected an .npz holding pointi, dest_x and dest_y"}
+                spec   = {name: arrays[name] for name in ["pointi", "dest_x", "dest_y"]}
+            else:
+                spec = json.loads(body)
+                if not isinstance(spec, dict) or not isinstance(spec.get("session"), str):
+                    return 400, {"error": "expected {\"session\": path}"}
+            if "neighbours" in query:
+                spec["neighbours"] = query["neighbours"]
+            if spec.get("neighbours") is not None:
+                spec["neighbours"] = int(spec["neighbours"])
+            job = self.submit(spec)
+            if job is None:
+                return 503, {"error": "the queue is full"}
+            if wait:
+                await job["done"].wait()
+                return 200, self.view(job)
+            return 202, self.view(job)
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = self.jobs.get(int(parts[1])) if parts[1].isdigit() else None
+            if job is None:
+                return 404, {"error": "no job {}".format(parts[1])}
+            if method == "GET":
+                if wait:
+                    await job["done"].wait()
+                return 200, self.view(job)
+            if method == "DELETE":
+                self.cancel(job)
+                return 200, self.view(job)
+            return 405, {"error": "{} /jobs/<id>".format(method)}
+        return 404, {"error": "no route {} {}".format(method, url.path)}
+
+    async def handle (self, reader, writer):
+        '''Answer one HTTP/1.1 request, then close the connection.'''
+        try:
+            method, target, _ = (await reader.readline()).decode().split()
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode().partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if length > MAX_BODY:
+                status, payload = 413, {"error": "the body exceeds {} bytes".format(MAX_BODY)}
+            else:
+                body = await reader.readexactly(length)
+                status, payload = await self.route(method, target, headers, body)
+        except (ValueError, KeyError, TypeError, IndexError, OSError,
+                asyncio.IncompleteReadError) as error:
+            # Whatever the client sent that cannot be parsed still gets
+            # an answer.
+            status, payload = 400, {"error": "{}: {}".format(type(error).__name__, error)}
+        data = json.dumps(payload).encode()
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n"
+                     "Content-Length: {}\r\nConnection: close\r\n\r\n"
+                     .format(status, REASONS[status], len(data)).encode() + data)
+        try:
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+async def serve (port=8765, socket=None, workers=None, blas_threads=1, queue=64):
+    # The workers are spawned with BLAS capped to blas_threads (see
+    # batch.py); this process only does light work, so the variables
+    # stay set.
+    os.environ.update({name: str(blas_threads) for name in batch.BLAS_THREAD_VARIABLES})
+    service = Service(workers, queue)
+    await service.start()
+    if socket:
+        server = await asyncio.start_unix_server(service.handle, socket)
+    else:
+        server = await asyncio.start_server(service.handle, "127.0.0.1", port)
+    # SIGINT and SIGTERM stop the service cleanly, workers included.
+    loop = asyncio.get_running_loop()
+    for number in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(number, asyncio.current_task().cancel)
+    print("ready on", socket or "127.0.0.1:{}".format(port), flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        service.stop()
+        if socket:
+            os.unlink(socket)
+
+def cli (argv=None):
+    parser = argparse.ArgumentParser(description="Serve the asymmetry test on localhost.")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="TCP port on 127.0.0.1 (default: 8765)")
+    parser.add_argument("--socket", default=None,
+                        help="listen on this Unix socket instead")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes, i.e. of concurrent jobs (default: cores)")
+    parser.add_argument("--blas-threads", type=int, default=1,
+                        help="BLAS threads per worker (default: 1)")
+    parser.add_argument("--queue", type=int, default=64,
+                        help="number of jobs that may wait (default: 64)")
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args.port, args.socket, args.workers, args.blas_threads, args.queue))
+
+if __name__ == "__main__":
+    cli()
@@ -1,5 +1,3 @@
-import math
-import scipy
 import numpy as np
 
 # Let $$F(x; d_{1}, d_{2}) = I_{d_{1}x/(d_{1}x+d_{2})}(d_{1}/2,
@@ -22,25 +20,28 @@ import numpy as np
 # regularized incomplete beta function.
 
 def cdf_F (x,n,m):
+    import scipy.special
     return scipy.special.betainc(n/2,m/2,n*x/(n*x+m))
 
 def sos (ts):
-    '''Sum of squares. E.g. [1,2,3] -> 14.'''
-    return sum(map((lambda t: t**2), ts))
+    '''Sum of squares. E.g. [1,2,3] -> 14. Stacks of samples are
+    summed along the last axis, as are the functions below.'''
+    return np.sum(np.square(ts), axis=-1)
 
 def sample_average (ts):
-    return sum(ts)/len(ts)
+    return np.mean(ts, axis=-1)
 
 def sample_variance_unnormalized (ts):
     '''Sample variance estimator, without dividing by (len(ts) -
     1). If ts is sampled from $N(\mu,\sigma^2)$, then the result
     should follow $\chi_{n-1}^2$.'''
-    assert(len(ts) > 1)
+    ts = np.asarray(ts, dtype=float)
+    assert(ts.shape[-1] > 1)
     E = sample_average(ts)
-    return sos(map((lambda t: t-E), ts))
+    return sos(ts - E[..., None])
 
 def sample_variance (ts):
-    return sample_variance_unnormalized(ts) / len(ts)
+    return sample_variance_unnormalized(ts) / np.shape(ts)[-1]
 
 # Assume xs and ys are sampled respectively from
 # N(mu,sigma^2) and N(mu',sigma'^2). We want to use F-test to
@@ -68,16 +69,22 @@ def sample_variance (ts):
 #
 # Finally, we define the p-value. If it is lower than 0.05,
 # we should reject H0 and accept H1.
-def f_test_1D (xs, ys):
-    '''Run F-test for the input arrays.'''
-    n     = len(xs)
-    m     = len(ys)
+def f_test_p_value (xs, ys):
+    '''The p-value of the F-test below, for stacks of samples along
+    the last axis.'''
+    n     = np.shape(xs)[-1]
+    m     = np.shape(ys)[-1]
     ratio = (sample_variance_unnormalized(xs)/n) / \
             (sample_variance_unnormalized(ys)/m)
+    t     = np.absolute(np.log(ratio))
+    p_value =      cdf_F(np.exp(-t),n-1,m-1) + \
+              (1 - cdf_F(np.exp( t),n-1,m-1))
+    return ratio, p_value
+
+def f_test_1D (xs, ys):
+    '''Run F-test for the input arrays.'''
+    ratio, p_value = f_test_p_value(xs, ys)
     print("f_test_1D: ratio: ", ratio)
-    t     = np.absolute(math.log(ratio))
-    p_value =      cdf_F(n-1,m-1, math.exp(-t)) + \
-              (1 - cdf_F(n-1,m-1, math.exp( t)))
     return p_value
 
 ### Testing..
@@ -101,42 +108,57 @@ def test_f_test_1D (cov1,cov2):
 # lengths into F-test. If the p-value is less than 0.05, we
 # reject H0, accept H1, and conclude that \lambda_1 is not
 # \lambda_1'.
+#
+# The first principal component is found by power iteration on the
+# smaller of the two Gram matrices of the centred data, so a call
+# costs a few matrix products instead of a full PCA. Stacks of
+# samples, of shape (..., n, p), are handled at once.
+def first_principal_scores (U, iterations=1000, tol=1e-12):
+    '''The coordinates of the rows of the centred data U along its
+    first principal component, up to a common sign.'''
+    n, p = U.shape[-2:]
+    K = U @ np.swapaxes(U, -1, -2) if n <= p else np.swapaxes(U, -1, -2) @ U
+    w = np.broadcast_to(np.random.default_rng(0).normal(size=K.shape[-1]), K.shape[:-1])
+    w = w / np.linalg.norm(w, axis=-1, keepdims=True)
+    for _ in range(iterations):
+        v = (K @ w[..., None])[..., 0]
+        v = v / np.linalg.norm(v, axis=-1, keepdims=True)
+        done = np.max(np.abs(np.abs(np.sum(v*w, axis=-1)) - 1)) < tol
+        w = v
+        if done:
+            break
+    if n <= p:
+        # w lives in the space of rows; the component is v = U^t w /
+        # |U^t w|, and U v = K w / sqrt(w^t K w).
+        Kw = (K @ w[..., None])[..., 0]
+        return Kw / np.sqrt(np.sum(w * Kw, axis=-1, keepdims=True))
+    return (U @ w[..., None])[..., 0]
+
 def one_dimensionalize (Xs):
-    from sklearn.decomposition import PCA
-    pca = PCA(n_components=1)
-    pca.fit(Xs)
-    mean = pca.mean_
-    cpnt = pca.components_[0]
-    result = []
-    for X in Xs:
-        u = (X-mean)
-        v = cpnt
-        result.append(np.dot(u,v)/(np.dot(v,v)**(1/2)))
-    return result
+    Xs = np.asarray(Xs, dtype=float)
+    return first_principal_scores(Xs - Xs.mean(axis=-2, keepdims=True))
 
 def f_test_higherD_naive (Xs, Ys):
     '''Main function: We project the X's onto the first principal
     component of Xs (similarly for Y's), and run the 1D f-test on
-    the lengths of the projected vectors.'''
-    n = len(Xs)
-    p = len(Xs[0])
-    assert(len(Xs)==len(Ys))
-    assert(len(Xs[0])==len(Ys[0]))
-    for k in range(n):
-        assert(len(Xs[0])==len(Xs[k]))
-        assert(len(Ys[0])==len(Ys[k]))
+    the lengths of the projected vectors. Xs and Ys are arrays of
+    shape (n, p), or stacks of them of shape (..., n, p), in which
+    case all the p-values are returned at once.'''
+    Xs = np.asarray(Xs, dtype=float)
+    Ys = np.asarray(Ys, dtype=float)
+    assert(Xs.ndim >= 2)
+    assert(Xs.shape == Ys.shape)
     Xs1D = one_dimensionalize(Xs)
     Ys1D = one_dimensionalize(Ys)
-    p_value = f_test_1D(Xs1D,Ys1D)
-    return p_value
+    return f_test_p_value(Xs1D,Ys1D)[1]
 
 # My observation is that |log(var1/var2)| has to be larger than
 # log(10) for the p_value to be < 0.05. Maybe it's not so bad.
 def test_ (var1, var2):
     '''Run the test for N(0,I) in 2000 dimensions.'''
     mean = 0
-    Xs = ([[np.random.normal(mean,var1) for p in range(2000)] for n in range(20)])
-    Ys = ([[np.random.normal(mean,var2) for p in range(2000)] for n in range(20)])
+    Xs = np.random.normal(mean,var1,(20,2000))
+    Ys = np.random.normal(mean,var2,(20,2000))
     return f_test_higherD_naive(Xs,Ys)
 
 # My observation is that |log(var1/var2)| has to be larger than
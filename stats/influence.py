@@ -0,0 +1,311 @@
+import numpy as np
+import instrument
+import stats.marietan_test as mt
+
+# Leave-one-frame-out diagnostics for the T1-test (see
+# marietan_test.py): T1 and its p-value with each frame left out, to
+# tell whether a single frame, e.g. a bad tracking frame whose NaN
+# displacements became 0 in stage_1, decides the test.
+#
+# Rerunning the test without each of the m frames costs m
+# eigendecompositions. Instead we decompose each sample once. Let X
+# be centralized, of shape (m, p), with scatter matrix X^t X = V
+# diag(l) V^t (or, in the dual form, Gram matrix X X^t = W diag(l)
+# W^t, and then V = X^t W diag(l)^(-1/2)). Leaving out frame f, whose
+# centralized row is x_f, changes the scatter matrix by the rank one
+# downdate
+#
+#   X^t X  ->  X^t X - r x_f x_f^t,    r = m/(m-1),
+#
+# (see online.py), so in the basis V it becomes diag(l) - r z z^t,
+# with z = V^t x_f, the row f of X V. The eigenvalues mu of such a
+# matrix are the roots of the secular equation
+#
+#   w(t) = 1 + r sum_i z_i^2/(t - l_i) = 0,
+#
+# one in each interval (l_{i+1}, l_i), where w decreases from +inf
+# to -inf. The test only needs the k largest ones, which we find by
+# safeguarded Newton steps on P below, and sums over the bulk of the
+# form
+#
+#   S_1 = sum mu/(t - mu),    S_2 = sum mu^2/(t - mu)^2
+#
+# at t = mu_s, s < k (see hat_hat_theta and M). These follow from the
+# old eigenvalues without the new ones, since prod (t - mu) = prod (t
+# - l_i) w(t). The pole of w at l_s is cancelled by the factor t -
+# l_s, so prod (t - mu) = prod_{i != s} (t - l_i) P(t), where
+#
+#   P(t) = (t - l_s) (1 + phi(t)) + r z_s^2,
+#   phi(t) = r sum_{i != s} z_i^2/(t - l_i),
+#
+# has a simple zero at mu_s: P(t) = a u + b u^2 + c u^3 + ... with
+# u = t - mu_s. Taking logarithmic derivatives, and removing the term
+# of mu_s,
+#
+#   sum_{bulk} 1/(t - mu)   = sum_{i != s} 1/(t - l_i) + b/a
+#                             - sum_{j<k, j!=s} 1/(t - mu_j),
+#   sum_{bulk} 1/(t - mu)^2 = sum_{i != s} 1/(t - l_i)^2 - (2c/a - (b/a)^2)
+#                             - sum_{j<k, j!=s} 1/(t - mu_j)^2,
+#
+# from which S_1 and S_2 follow, writing mu/(t - mu) = t/(t - mu) - 1.
+# Leaving the pole out keeps them accurate when z_s is tiny and mu_s
+# is within rounding of l_s. Each frame thus costs O(k p) per Newton
+# step instead of an eigendecomposition.
+
+def downdates (X):
+    '''The eigenvalues l of the scatter matrix of the centralized X,
+    of shape (m, p), in descending order, and the matrix Z whose row
+    f holds the coordinates of the centralized frame f in its
+    eigenvectors.'''
+    m, p = X.shape
+    instrument.count("eigendecompositions")
+    instrument.size("eigendecomposition", (min(m, p),)*2)
+    if m <= p:
+        l, W = np.linalg.eigh(X @ X.T)
+        l, W = np.maximum(l[::-1], 0), W[:, ::-1]
+        return l, W * np.sqrt(l)
+    l, V = np.linalg.eigh(X.T @ X)
+    return np.maximum(l[::-1], 0), X @ V[:, ::-1]
+
+def secular_roots (l, z2, r, k, tol=4*np.finfo(float).eps, iterations=100):
+    '''The k largest roots of the secular equation of the downdates
+    diag(l) - r z z^t, for each row z2 = z**2 of the (frames, d)
+    array z2. Returns an array of shape (frames, k).'''
+    pole = np.arange(len(l)) == np.arange(k)[:, None]
+    l_s  = l[:k]
+    z_s  = r * z2[:, :k]
+    lo   = np.broadcast_to(l[1:k+1], z_s.shape).copy()
+    hi   = np.broadcast_to(l_s, z_s.shape).copy()
+    # Safeguarded Newton steps on P (see above), which is smooth at
+    # l_s, starting from the root of P with phi frozen at l_s.
+    t    = None
+    for _ in range(iterations):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            q    = np.where(pole, 0, 1 / ((l_s if t is None else t)[..., None] - l))
+            zq   = r * z2[:, None, :] * q
+            phi  = zq.sum(axis=-1)
+            if t is None:
+                step = l_s - z_s / (1 + phi)
+            else:
+                P    = (t - l_s) * (1 + phi) + z_s
+                lo   = np.where(P < 0, t, lo)
+                hi   = np.where(P < 0, hi, t)
+                step = t - P / (1 + phi - (t - l_s) * (zq * q).sum(axis=-1))
+        step = np.where((lo <= step) & (step <= hi), step, (lo + hi) / 2)
+        if t is not None and np.all(np.abs(step - t) <= tol * np.abs(t)):
+            return step
+        t = step
+    return t
+
+def bulk_sums (l, z2, r, mu):
+    '''S_1 and S_2 over the bulk of the downdates at t = mu_s, for
+    the k largest eigenvalues mu (frames, k) of the downdates. Returns
+    two arrays of shape (frames, k).'''
+    k    = mu.shape[-1]
+    t    = mu[..., None]
+    # The terms of the pole i = s are left out of every sum.
+    pole = np.arange(len(l)) == np.arange(k)[:, None]
+    with np.errstate(divide="ignore"):
+        q = np.where(pole, 0, 1 / (t - l))
+    zq   = r * z2[:, None, :] * q
+    phi  = [zq.sum(axis=-1), -(zq * q).sum(axis=-1), 2 * (zq * q**2).sum(axis=-1),
+            -6 * (zq * q**3).sum(axis=-1)]
+    u    = mu - l[:k]
+    P_1  = 1 + phi[0] + u * phi[1]
+    beta = (2*phi[1] + u*phi[2]) / (2*P_1)
+    gam  = (3*phi[2] + u*phi[3]) / (6*P_1)
+    g    = l * q                                # l/(t - l)
+    # The other leading eigenvalues, mu_j/(t - mu_j) for j != s.
+    with np.errstate(divide="ignore"):
+        h = mu[..., None, :] / (t - mu[..., None, :])
+    h[..., np.arange(k), np.arange(k)] = 0
+    S1 = g.sum(axis=-1) - h.sum(axis=-1) + mu * beta
+    S2 = (g**2).sum(axis=-1) - (h**2).sum(axis=-1) - mu**2 * (2*gam - beta**2) - 2*mu * beta
+    return S1, S2
+
+def leave_one_out_terms (X, k=mt.SPIKE_ORDER, chunk=256):
+    '''The spectrum of the sample X (m, p), and hat_hat_theta and
+    sigma_square of the spikes s < k (as in T_1_of_spectra) with each
+    frame left out, as two arrays of shape (m, k).'''
+    X    = mt.centralize(np.asarray(X, dtype=float))
+    m    = len(X)
+    l, Z = downdates(X)
+    full = mt.Spectrum(np.concatenate([l, np.zeros(max(0, m - len(l)))]) / m)
+    r    = m / (m - 1)
+    n    = m - 1 - k                 # the size of the bulk without a frame
+    theta, sigma2 = np.empty((m, k)), np.empty((m, k))
+    for start in range(0, m, chunk):
+        z2     = Z[start:start+chunk]**2
+        mu     = secular_roots(l, z2, r, k)
+        S1, S2 = bulk_sums(l, z2, r, mu)
+        M_11, M_22 = S1 / n, S2 / n
+        theta[start:start+chunk]  = 1 + n / S1
+        sigma2[start:start+chunk] = 2 * (M_22 - M_11**2) / M_11**4
+    return full, theta, sigma2
+
+@instrument.staged
+def leave_one_out (X, Y, k=mt.SPIKE_ORDER, threshold=0.05):
+    '''The T1-test of X and Y (m, p) with each of the m frames left
+    out. Returns a dict holding the "T1" and "p_value" of all the
+    frames, the "T1_without" and "p_value_without" each frame, of
+    shape (m,), and the frames whose removal flips the decision at
+    level threshold, as "flips".'''
+    m = np.shape(X)[0]
+    assert min(m - 2, np.shape(X)[1]) > k, "Too few frames or columns for the spike order."
+    S_X, theta_X, sigma2_X = leave_one_out_terms(X, k)
+    S_Y, theta_Y, sigma2_Y = leave_one_out_terms(Y, k)
+    T1_without = (m - 1) * np.sum((theta_X - theta_Y)**2 / (sigma2_X + sigma2_Y), axis=-1)
+    p_without  = mt.chi2_p_value(T1_without, k)
+    T1         = mt.T_1_of_spectra(S_X, S_Y, m, k)
+    p_value    = mt.chi2_p_value(T1, k)
+    return {"T1"             : float(T1),
+            "p_value"        : float(p_value),
+            "T1_without"     : T1_without,
+            "p_value_without": p_without,
+            "flips"          : np.flatnonzero((p_without < threshold) != (p_value < threshold))}
+
+# The contribution of a pair of landmarks (left_ids[j], right_ids[j])
+# is the drop of T1 when its columns, two in L and two in R, are left
+# out. In the eigenbasis of the Gram matrix of X, this changes diag(l)
+# into diag(l) - A A^t, where the two columns of A (d, 2) hold the
+# coordinates of the columns of the pair (the rows of C below), a
+# rank two downdate. Let a_i be the row i of A and
+#
+#   G(t) = I + sum_i a_i a_i^t/(t - l_i),
+#
+# a 2 x 2 matrix. Then det(t - diag(l) + A A^t) = prod (t - l_i)
+# det G(t), and by the inertia of the bordered matrix [[diag(l) - t,
+# A], [A^t, I]], the number of new eigenvalues above t is the number
+# of l_i above t minus the number of negative eigenvalues of G(t).
+# The new eigenvalue mu_s lies between l_{s+2} and l_s, and is found
+# by bisection on that count, as two new eigenvalues may share an
+# interval between the l_i.
+#
+# The sums over the bulk then follow like above, with the pole pi of
+# the old eigenvalue nearest to mu_s removed. Writing E(t) = I +
+# sum_{i != pi} a_i a_i^t/(t - l_i),
+#
+#   prod (t - mu) = prod_{i != pi} (t - l_i) Q(t),
+#   Q(t) = (t - l_pi) det E(t) + a_pi^t adj(E(t)) a_pi,
+#
+# where Q is smooth at l_pi, and the Taylor coefficients of Q at mu_s
+# take the place of those of P. Each pair thus costs O(k d) per
+# bisection step instead of an eigendecomposition.
+
+def column_coordinates (X):
+    '''The eigenvalues l of the Gram matrix of the centralized X, of
+    shape (m, p), in descending order, and the matrix C (p, d) whose
+    row c holds the coordinates of the column c in its
+    eigenvectors.'''
+    m, p = X.shape
+    instrument.count("eigendecompositions")
+    instrument.size("eigendecomposition", (min(m, p),)*2)
+    if m <= p:
+        l, W = np.linalg.eigh(X @ X.T)
+        return np.maximum(l[::-1], 0), X.T @ W[:, ::-1]
+    l, V = np.linalg.eigh(X.T @ X)
+    l    = np.maximum(l[::-1], 0)
+    return l, V[:, ::-1] * np.sqrt(l)
+
+def _outer_sums (w, A2):
+    '''The entries (0 0, 1 1, 0 1) of sum_i w_i a_i a_i^t, for w of
+    shape (pairs, k, d) and A2 (pairs, d, 3) holding a_i0^2, a_i1^2
+    and a_i0 a_i1.'''
+    return np.moveaxis(w @ A2, -1, 0)
+
+def downdate_roots (l, A, k, tol=4*np.finfo(float).eps, iterations=200):
+    '''The k largest eigenvalues of the downdates diag(l) - A A^t, for
+    a stack A of shape (pairs, d, 2). Returns an array of shape
+    (pairs, k).'''
+    A2 = np.stack([A[..., 0]**2, A[..., 1]**2, A[..., 0]*A[..., 1]], axis=-1)
+    ls = np.concatenate([l, np.zeros(2)])
+    lo = np.broadcast_to(ls[2:k+2], A.shape[:1] + (k,)).copy()
+    hi = np.broadcast_to(ls[:k], lo.shape).copy()
+    s  = np.arange(k)
+    for _ in range(iterations):
+        t = (lo + hi) / 2
+        with np.errstate(divide="ignore"):
+            e00, e11, e01 = _outer_sums(1 / (t[..., None] - l), A2)
+        e00, e11 = 1 + e00, 1 + e11
+        det      = e00 * e11 - e01**2
+        negative = np.where(det < 0, 1, np.where(e00 + e11 < 0, 2, 0))
+        above    = np.searchsorted(-l, -t) - negative > s
+        lo, hi   = np.where(above, t, lo), np.where(above, hi, t)
+        if np.all(hi - lo <= tol * hi):
+            break
+    return (lo + hi) / 2
+
+def _product (f, g):
+    '''The product of two truncated Taylor series, given by their
+    coefficients along the first axis.'''
+    return np.stack([sum(f[i] * g[n-i] for i in range(n+1)) for n in range(len(f))])
+
+def downdate_bulk_sums (l, A, mu):
+    '''S_1 and S_2 over the bulk of the downdates diag(l) - A A^t at
+    t = mu_s, for the k largest eigenvalues mu (pairs, k) of the
+    downdates. Returns two arrays of shape (pairs, k).'''
+    k    = mu.shape[-1]
+    t    = mu[..., None]
+    pole = np.argmin(np.abs(t - l), axis=-1)
+    mask = np.arange(len(l)) == pole[..., None]
+    with np.errstate(divide="ignore"):
+        q = np.where(mask, 0, 1 / (t - l))
+    A2   = np.stack([A[..., 0]**2, A[..., 1]**2, A[..., 0]*A[..., 1]], axis=-1)
+    # The Taylor coefficients of the entries of E at mu_s.
+    E    = np.stack([(-1)**n * np.stack(_outer_sums(q**(n+1), A2)) for n in range(4)])
+    E[0, :2] += 1
+    e00, e11, e01 = E[:, 0], E[:, 1], E[:, 2]
+    det  = _product(e00, e11) - _product(e01, e01)
+    a    = np.take_along_axis(A, pole[..., None], axis=1)          # (pairs, k, 2)
+    a0, a1 = a[..., 0], a[..., 1]
+    adj  = e11 * a0**2 + e00 * a1**2 - 2 * e01 * a0 * a1
+    u    = mu - np.take(l, pole)
+    Q    = u * det + adj
+    Q[1:] += det[:-1]
+    beta = Q[2] / Q[1]
+    gam  = Q[3] / Q[1]
+    g    = l * q
+    with np.errstate(divide="ignore"):
+        h = mu[..., None, :] / (t - mu[..., None, :])
+    h[..., np.arange(k), np.arange(k)] = 0
+    S1 = g.sum(axis=-1) - h.sum(axis=-1) + mu * beta
+    S2 = (g**2).sum(axis=-1) - (h**2).sum(axis=-1) - mu**2 * (2*gam - beta**2) - 2*mu * beta
+    return S1, S2
+
+def pair_terms (X, k=mt.SPIKE_ORDER, chunk=128):
+    '''The spectrum of the sample X (m, 2*pairs), and hat_hat_theta
+    and sigma_square of the spikes s < k with the two columns of each
+    pair left out, as two arrays of shape (pairs, k).'''
+    X     = mt.centralize(np.asarray(X, dtype=float))
+    m     = len(X)
+    l, C  = column_coordinates(X)
+    full  = mt.Spectrum(np.concatenate([l, np.zeros(max(0, m - len(l)))]) / m)
+    pairs = C.reshape(-1, 2, C.shape[-1]).swapaxes(-1, -2)           # (pairs, d, 2)
+    n     = m - k
+    theta, sigma2 = np.empty((len(pairs), k)), np.empty((len(pairs), k))
+    for start in range(0, len(pairs), chunk):
+        A      = pairs[start:start+chunk]
+        mu     = downdate_roots(l, A, k)
+        S1, S2 = downdate_bulk_sums(l, A, mu)
+        M_11, M_22 = S1 / n, S2 / n
+        theta[start:start+chunk]  = 1 + n / S1
+        sigma2[start:start+chunk] = 2 * (M_22 - M_11**2) / M_11**4
+    return full, theta, sigma2
+
+@instrument.staged
+def pair_contributions (L, R, k=mt.SPIKE_ORDER):
+    '''The contribution of each pair j of landmarks, whose columns in
+    L and R (m, 2*pairs) are 2j and 2j+1 as stage_3 gathers them, to
+    the T1-test of L and R. Returns a dict holding "T1" and "p_value",
+    and "T1_without" and "contribution" = T1 - T1_without of each
+    pair, of shape (pairs,).'''
+    m = np.shape(L)[0]
+    assert min(m - 1, np.shape(L)[1] - 2) > k, "Too few frames or columns for the spike order."
+    S_X, theta_X, sigma2_X = pair_terms(L, k)
+    S_Y, theta_Y, sigma2_Y = pair_terms(R, k)
+    T1_without = m * np.sum((theta_X - theta_Y)**2 / (sigma2_X + sigma2_Y), axis=-1)
+    T1         = float(mt.T_1_of_spectra(S_X, S_Y, m, k))
+    return {"T1"          : T1,
+            "p_value"     : float(mt.chi2_p_value(T1, k)),
+            "T1_without"  : T1_without,
+            "contribution": T1 - T1_without}
@@ -1,6 +1,7 @@
 import math
-import scipy
 import numpy as np
+from typing import NamedTuple
+import instrument
 
 # We implement the test statistics T_{1} in [5] in order to tell
 # if two covariance matrices are different. Recall that the paper
@@ -31,59 +32,119 @@ x = np.random.rand(100, 1000)
 x[:, 0:3] *= 100
 y = np.random.rand(100, 1000)
 
+For samples of the spiked model itself, in bulk, see
+stats/simulation.py.
 """
 
-_k = 3 # This is the order in the spike model.
-
-# TODO May want to cache this function.
-def ordered_eigens (M):
-    '''We order the eigenvalues from the largest to smallest.'''
-    eigvals, eigvecs = np.linalg.eig(M)
-    idx = eigvals.argsort()[::-1]
-    eigvals = eigvals[idx]
-    eigvecs = eigvecs[:,idx]
-    return {"eigvals": eigvals, "eigvecs": eigvecs}
+# The order of the spike model, unless told otherwise. Every
+# function taking the order has it as its argument k, so different
+# orders can be used side by side (and from different threads).
+SPIKE_ORDER = 3
 
 def hat_Sigma(X):
-    m = len(X)
-    X = np.array(X)
-    return X @ X.T / m
+    X = np.asarray(X)
+    m = X.shape[-2]
+    return X @ np.swapaxes(X, -1, -2) / m
+
+class Spectrum (NamedTuple):
+    '''The eigenvalues of hat_Sigma(X) ordered from the largest
+    to the smallest, and the corresponding eigenvectors as columns.'''
+    eigvals : np.ndarray
+    eigvecs : np.ndarray = None
+
+# hat_Sigma(X) is m x m for X of shape (m, p). If m > p, we rather
+# decompose the Gram matrix X^t X / m, which is p x p and has the same
+# nonzero eigenvalues; the other m - p eigenvalues are 0. Since all
+# the sums over the bulk eigenvalues below vanish at 0, the spectrum
+# is padded with zeros and the costs grow with min(m, p) only.
+def spectrum (X):
+    '''Eigendecompose hat_Sigma(X) once. As hat_Sigma(X) is
+    symmetric, we use the symmetric solver, whose output is real
+    and in ascending order. In the dual form (more rows than columns)
+    only the eigenvalues are kept. A stack of samples of shape (...,
+    m, p) gives a stack of spectra.'''
+    X    = np.asarray(X)
+    m, p = X.shape[-2:]
+    instrument.count("eigendecompositions", int(np.prod(X.shape[:-2])))
+    instrument.size("eigendecomposition", (min(m, p),)*2)
+    if m <= p:
+        eigvals, eigvecs = np.linalg.eigh(hat_Sigma(X))
+        return Spectrum(eigvals[..., ::-1], eigvecs[..., :, ::-1])
+    eigvals = np.linalg.eigvalsh(np.swapaxes(X, -1, -2) @ X / m)
+    zeros   = np.zeros(eigvals.shape[:-1] + (m - p,))
+    return Spectrum(np.concatenate([eigvals[..., ::-1], zeros], axis=-1))
 
 # Then we define $\hat{\hat{\theta_s}} (s = 1 \ldots k)$ do be
-# the following.
-def hat_hat_theta (s, hat_Sigma):
+# the following. The sums run over the bulk eigenvalues
+# $\hat{\lambda}_{k+1}, .., \hat{\lambda}_{m}$. The spectrum may
+# be a stack of spectra (eigvals of shape (..., m)), and s may be
+# an array of indices; the result then has shape (..., *s.shape).
+def hat_hat_theta (s, spectrum, k=SPIKE_ORDER):
     '''The unbiased estimators of \theta_s; see [5, Def 2.2].'''
-    assert(0<=s<=_k)
-    m = len(hat_Sigma)
-    eigvals = ordered_eigens(hat_Sigma)["eigvals"]
-    denom  = 0
-    for i in range(_k,m):
-        denom += eigvals[i] / (eigvals[s] - eigvals[i])
-    return 1 + (m-_k)/denom
-
-def hat_hat_Sigma (hat_Sigma):
-    '''The filtered estimated covariance matrix; see [5, Def 2.2].'''
-    eigvecs = ordered_eigens(hat_Sigma)["eigvecs"]
-    m = len(hat_Sigma)
-    result = np.identity(m)
-    for i in range(_k):
-        result = result + hat_hat_theta(i, hat_Sigma) * eigvecs[i].T @ eigvecs[i]
-    return result
-
-def M (s1, s2, X, rho):
-    '''[5, sec 2.5]'''
-    m = len(X)
-    eigvals = ordered_eigens(hat_Sigma(X))["eigvals"]
-    result = 0
-    for i in range(_k,m):
-        result += eigvals[i]**s1 / (rho - eigvals[i])**s2
-    return result / (m-_k)
-
-def sigma_square (X, rho):
+    s       = np.asarray(s)
+    assert(np.all((0<=s) & (s<k)))
+    eigvals = spectrum.eigvals
+    m       = eigvals.shape[-1]
+    bulk    = eigvals[..., None, k:]
+    theta   = eigvals[..., s.ravel(), None]
+    denom   = np.sum(bulk / (theta - bulk), axis=-1)
+    return (1 + (m-k)/denom).reshape(eigvals.shape[:-1] + s.shape)
+
+def hat_hat_Sigma (spectrum, k=SPIKE_ORDER):
+    '''The filtered estimated covariance matrix; see [5, Def 2.2].
+    The eigenvectors are the columns of spectrum.eigvecs, so the
+    spikes add theta_s v_s v_s^t for the first k columns v_s.'''
+    eigvecs = spectrum.eigvecs
+    assert eigvecs is not None, "The dual form keeps no eigenvectors."
+    m = eigvecs.shape[-1]
+    V = eigvecs[..., :, :k]
+    theta = hat_hat_theta(np.arange(k), spectrum, k)
+    return np.identity(m) + (V * theta[..., None, :]) @ np.swapaxes(V, -1, -2)
+
+def M (s1, s2, spectrum, rho, k=SPIKE_ORDER):
+    '''[5, sec 2.5] The average over the bulk eigenvalues. The
+    shape of rho starts with the stack shape of the spectrum.'''
+    bulk = spectrum.eigvals[..., k:]
+    rho  = np.asarray(rho)
+    r    = rho.reshape(bulk.shape[:-1] + (-1, 1))
+    bulk = bulk[..., None, :]
+    return np.mean(bulk**s1 / (r - bulk)**s2, axis=-1).reshape(rho.shape)
+
+def sigma_square (spectrum, rho, k=SPIKE_ORDER):
     '''[5. section 2.4, p.6]'''
-    return 2 * (M(2,2,X,rho) - M(1,1,X,rho)**2) / M(1,1,X,rho)**4
-
-def T_1 (X, Y):
+    M_11 = M(1,1,spectrum,rho,k)
+    return 2 * (M(2,2,spectrum,rho,k) - M_11**2) / M_11**4
+
+def T_1_of_spectra (S_X, S_Y, m, k=SPIKE_ORDER):
+    '''T_1 computed from the spectra of X and Y, where m is the
+    number of samples. Stacks of spectra give a stack of T_1.'''
+    s     = np.arange(k)
+    numer = (hat_hat_theta(s, S_X, k) - hat_hat_theta(s, S_Y, k))**2
+    denom = sigma_square(S_X, S_X.eigvals[..., s], k) + \
+            sigma_square(S_Y, S_Y.eigvals[..., s], k) # p.6
+    return m * np.sum(numer / denom, axis=-1)
+
+# The spike order may also be estimated from the spectrum itself. We
+# use the eigenvalue ratio estimator of [10]: the order is the i <=
+# k_max at which the drop from the eigenvalue i to the eigenvalue
+# i+1 is the largest, relative to the eigenvalue i+1. Only the
+# eigenvalues within the numerical rank count: the zeros padding the
+# dual form, and the eigenvalues within rounding of zero, would give
+# huge ratios that say nothing about the spikes.
+def spike_order (spectrum, k_max):
+    '''The estimated spike order of spectrum, at most k_max and at
+    most its numerical rank (the eigenvalues above m eps times the
+    largest). A stack of spectra gives a stack of orders.'''
+    eigvals = spectrum.eigvals
+    k_max   = min(k_max, eigvals.shape[-1] - 2)
+    tol     = eigvals.shape[-1] * np.finfo(float).eps * eigvals[..., :1]
+    ranked  = eigvals[..., 1:k_max+1] > tol
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = eigvals[..., :k_max] / eigvals[..., 1:k_max+1]
+    return 1 + np.argmax(np.where(ranked, ratios, 0), axis=-1)
+
+@instrument.staged
+def T_1 (X, Y, k=SPIKE_ORDER):
     '''The test statistics $T_1$ in [5, page 5], where the
     denominator $\sigma$ is given on page 6, and where $\rho$ is
     replaced with $\hat{\theta}$ (which is just $\hat{\theta}$ by
@@ -93,36 +154,50 @@ def T_1 (X, Y):
     hypothesis H_0 therein, this is going to be ~ $\chi_k^2$, the
     chi-square distribution of k freedoms.
     '''
-    m          = len(X)
-    result     = 0
-    eigvals_X  = ordered_eigens(hat_Sigma(X))["eigvals"]
-    eigvals_Y  = ordered_eigens(hat_Sigma(Y))["eigvals"]
-    # TODO can be more efficient by avoiding recomputing the eigens of X and Y.
-    for i in range(_k):
-        numer   = (hat_hat_theta(i, hat_Sigma(X)) - hat_hat_theta(i, hat_Sigma(Y)))**2
-        denom   = sigma_square(X, eigvals_X[i])   + sigma_square(Y, eigvals_Y[i]) # p.6
-        result += numer / denom
-    return m * result
+    return T_1_of_spectra(spectrum(X), spectrum(Y), np.shape(X)[-2], k)
 
 def centralize (X):
-    X = np.array(X)
-    mean = 0
-    for x in X:
-        mean = mean + x
-    mean = mean / len(X)
-    return X - np.array([mean for i in range(len(X))])
-
-def marietan_T1_test (X, Y):
+    '''Subtract the sample average from each row of X. Arrays are
+    used as they are, so this makes the only copy of X. Stacks of
+    samples are centralized one by one.'''
+    X = np.asarray(X)
+    return X - X.mean(axis=-2, keepdims=True)
+
+@instrument.staged
+def marietan_T1_test (X, Y, k=SPIKE_ORDER):
     '''Based on [5, sec 2.4], if H0 is satisfied, then $T1 \sim
     \chi^2_k$, whose cdf is the incomplete gamma function [6][7],
     and T1 should be as close as to zero. We therefore construct
-    the p-value by measuring how far it is from zero.'''
-    X       = centralize(X)
-    Y       = centralize(Y)
-    a       = _k/2
-    b       = np.real(T_1(X,Y)/2)
-    p_value = 1 - scipy.special.gammainc(a,b)
-    return p_value
+    the p-value by measuring how far it is from zero. Stacks of
+    samples X and Y of shape (..., m, p) give all the p-values at
+    once.
+
+    If k is a list of spike orders, X and Y are still decomposed
+    once, and the result is a dict holding the orders "k", and "T1"
+    and "p_value" with a last axis running over them, along with the
+    orders "k_hat_X" and "k_hat_Y" estimated by spike_order (at most
+    max(k)).'''
+    X = centralize(X)
+    Y = centralize(Y)
+    if np.ndim(k) == 0:
+        return chi2_p_value(T_1(X,Y,k), k)
+    ks  = [int(order) for order in k]
+    m   = np.shape(X)[-2]
+    S_X = spectrum(X)
+    S_Y = spectrum(Y)
+    T1  = np.stack([T_1_of_spectra(S_X, S_Y, m, order) for order in ks], axis=-1)
+    return {"k"      : ks,
+            "T1"     : T1,
+            "p_value": chi2_p_value(T1, np.array(ks)),
+            "k_hat_X": spike_order(S_X, max(ks)),
+            "k_hat_Y": spike_order(S_Y, max(ks))}
+
+def chi2_p_value (T1, k=SPIKE_ORDER):
+    '''The probability that a chi^2_k variable exceeds T1.'''
+    import scipy.special
+    a = np.asarray(k)/2
+    b = np.asarray(T1)/2
+    return 1 - scipy.special.gammainc(a,b)
 
 # References
 #
@@ -133,3 +208,7 @@ def marietan_T1_test (X, Y):
 # + [6] https://en.wikipedia.org/wiki/Chi-squared_distribution#Cumulative_distribution_function
 #
 # + [7] https://en.wikipedia.org/wiki/Incomplete_gamma_function
+#
+# + [10] Ahn, S. C. and Horenstein, A. R. (2013), Eigenvalue Ratio
+# Test for the Number of Factors. Econometrica 81, 1203-1227.
+# https://doi.org/10.3982/ECTA8968
@@ -0,0 +1,90 @@
+import numpy as np
+import instrument
+import stats.marietan_test as mt
+
+# The rate of asymmetry of the archived pipeline (see `asymmetry` in
+# .archive/old_main_dir/main.py) compares the principal components
+# of the left and the right displacements. Let X be the centralized
+# L, with m rows. Its principal directions are the right singular
+# vectors v_i of X, and the length of the i-th component is
+# l_i = s_i / \sqrt{m-1}, where s_i is the i-th singular value
+# (PCA's explained variance is l_i^2). Likewise for Y, the
+# centralized R, with w_i and r_i. For each i we report
+#
+#   the angle      between v_i and w_i,
+#   the distance   |l_i v_i - r_i w_i|,
+#   the ratio      l_i / r_i,
+#
+# and the rate is the average distance, weighted by (l_i + r_i)/2,
+# relative to (l_1 + r_1)/2.
+#
+# The spectrum used by the T1-test (see marietan_test.py) already
+# eigendecomposes hat_Sigma(X) = X X^t / m = U diag(s^2/m) U^t, and
+# then the rows of U^t X are the s_i v_i. So given that spectrum the
+# components only cost one matrix product, and no second SVD.
+#
+# The sign of a principal direction is arbitrary; the archived code
+# inherited whatever sign sklearn picked. Here each w_i is rather
+# turned to make an angle of at most 90 degrees with v_i, so that the
+# distances only measure the asymmetry.
+
+def principal_components (X, spectrum=None):
+    '''The lengths l (..., n) and the unit directions V (..., n, p) of
+    the n = min(m, p) principal components of the centralized X, of
+    shape (..., m, p). If the spectrum of X (with eigenvectors) is
+    given, it is used instead of an SVD. Components within rounding
+    of zero (like the last one, as X is centralized) get length 0
+    and direction 0.'''
+    X    = np.asarray(X, dtype=float)
+    m, p = X.shape[-2:]
+    if spectrum is not None and spectrum.eigvecs is not None:
+        W = np.swapaxes(spectrum.eigvecs, -1, -2) @ X
+        s = np.linalg.norm(W, axis=-1)
+    else:
+        instrument.count("svds", int(np.prod(X.shape[:-2])))
+        _, s, W = np.linalg.svd(X, full_matrices=False)
+        W = W * s[..., None]
+    # The eigenvalues of hat_Sigma are accurate to about eps times
+    # the largest one, so the lengths from them to its square root.
+    s = np.where(s > np.sqrt(max(m, p) * np.finfo(float).eps) * s.max(axis=-1, keepdims=True), s, 0)
+    V = np.divide(W, s[..., None], out=np.zeros_like(W), where=s[..., None] > 0)
+    return s / np.sqrt(m - 1), V
+
+def asymmetry_rate (X, Y, S_X=None, S_Y=None):
+    '''The rate of asymmetry between the centralized samples X and Y,
+    of shape (..., m, p), and the table it comes from, as a dict of
+    arrays with a last axis running over the components: "left" and
+    "right" lengths, "angle" (in radians), "distance" and
+    "length_ratio". S_X and S_Y are optional spectra of X and Y to
+    share with the T1-test.'''
+    l, V  = principal_components(X, S_X)
+    r, W  = principal_components(Y, S_Y)
+    cos   = np.einsum("...ip,...ip->...i", V, W)
+    sign  = np.where(cos < 0, -1, 1)
+    known = (l > 0) & (r > 0)
+    angle = np.where(known, np.arccos(np.clip(sign*cos, 0, 1)), np.nan)
+    distance = np.linalg.norm(l[..., None]*V - (sign*r)[..., None]*W, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = l / r
+    n    = l.shape[-1]
+    rate = np.sum((l + r)/2 * distance, axis=-1) / (n * (l[..., 0] + r[..., 0])/2)
+    return {"rate"        : rate,
+            "left"        : l,
+            "right"       : r,
+            "angle"       : angle,
+            "distance"    : distance,
+            "length_ratio": ratio}
+
+@instrument.staged
+def asymmetry_report (L, R, k=mt.SPIKE_ORDER):
+    '''The T1-test and the rate of asymmetry of L and R from one
+    eigendecomposition of each. Returns a dict holding "T1",
+    "p_value" and "asymmetry_rate".'''
+    X   = mt.centralize(L)
+    Y   = mt.centralize(R)
+    S_X = mt.spectrum(X)
+    S_Y = mt.spectrum(Y)
+    T1  = mt.T_1_of_spectra(S_X, S_Y, X.shape[-2], k)
+    return {"T1"            : T1,
+            "p_value"       : mt.chi2_p_value(T1, k),
+            "asymmetry_rate": asymmetry_rate(X, Y, S_X, S_Y)["rate"]}
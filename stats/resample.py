@@ -0,0 +1,116 @@
+import os
+import numpy as np
+import concurrent.futures
+import stats.marietan_test as mt
+
+# The p-value of marietan_T1_test relies on T1 being ~ \chi^2_k,
+# which is only asymptotic. With as few as ~10 frames we rather
+# estimate the null distribution of T1 by resampling. Under H0, the
+# row L[i] and the row R[i] of the same frame are exchangeable, so
+# swapping them for a random subset of frames gives another draw of
+# (X, Y) with the same distribution. The empirical p-value is then
+# the proportion of swapped draws whose T1 is at least the
+# observed one [8].
+#
+# Each swapped X (resp. Y) only consists of rows of Z = [L; R], so
+# its Gram matrix is a submatrix of G = Z Z^t. We compute G once;
+# afterwards each resample costs O(m^2) for centralizing plus the
+# eigenvalues of an m x m matrix, no matter how many coordinates
+# there are, and a batch of resamples is one stacked np.linalg.eigvalsh.
+
+def swapped_spectra (G, swaps):
+    '''The spectra of hat_Sigma(centralize(X)) and
+    hat_Sigma(centralize(Y)) for a stack of swaps. G is the Gram
+    matrix of Z = [L; R], and swaps is a boolean array of shape
+    (resamples, m) telling in which frames L and R are swapped.'''
+    m      = swaps.shape[-1]
+    frames = np.arange(m)
+    def spectrum_of (rows):
+        H = G[rows[..., :, None], rows[..., None, :]]
+        # centralize(X) is C X with C = I - 11^t/m, so its Gram matrix
+        # is C (X X^t) C.
+        H = H - H.mean(axis=-1, keepdims=True) \
+              - H.mean(axis=-2, keepdims=True) \
+              + H.mean(axis=(-2,-1), keepdims=True)
+        return mt.Spectrum(np.linalg.eigvalsh(H / m)[..., ::-1])
+    return (spectrum_of(frames + m*swaps), spectrum_of(frames + m*~swaps))
+
+def _exceedances (G, T_obs, seed, size, k):
+    '''Count the resamples, out of size many, whose T1 is at least
+    T_obs. The swaps are drawn from the stream given by seed.'''
+    m     = len(G) // 2
+    rng   = np.random.default_rng(seed)
+    swaps = rng.random((size, m)) < 0.5
+    T     = mt.T_1_of_spectra(*swapped_spectra(G, swaps), m, k)
+    return int(np.count_nonzero(T >= T_obs))
+
+def clopper_pearson (count, total, confidence):
+    '''The exact confidence interval of a binomial proportion [9].'''
+    import scipy.special
+    a     = (1 - confidence) / 2
+    lower = scipy.special.betaincinv(count, total-count+1, a) if count > 0 else 0.0
+    upper = scipy.special.betaincinv(count+1, total-count, 1-a) if count < total else 1.0
+    return (float(lower), float(upper))
+
+def marietan_T1_resampling_test (X, Y, resamples=10000, threshold=0.05,
+                                 confidence=0.99, batch=1000,
+                                 workers=None, seed=None, k=mt.SPIKE_ORDER):
+    '''Resampling version of marietan_T1_test. X and Y have one row
+    per frame, and the rows of the same frame are swapped at random
+    to sample T1 under H0.
+
+    The resamples are drawn in batches, each from its own child of
+    np.random.SeedSequence(seed), and spread over a process pool of
+    workers (in this process if workers == 1). The batches are
+    accounted in order, so that the result only depends on seed. We
+    stop early once the confidence band of the p-value lies entirely
+    above or below threshold; the pool only gets a wave of one batch
+    per worker at a time, so stopping early also saves the work.
+
+    Returns a dict with the observed "T1", the empirical "p_value",
+    its Clopper-Pearson "band", and the number of "resamples" used.'''
+    X = np.asarray(X)
+    Y = np.asarray(Y)
+    assert(X.shape == Y.shape)
+    m     = len(X)
+    Z     = np.concatenate([X, Y])
+    G     = Z @ Z.T
+    T_obs = mt.T_1_of_spectra(*swapped_spectra(G, np.zeros((1, m), bool)), m, k)[0]
+    sizes = [min(batch, resamples - start) for start in range(0, resamples, batch)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    count, total, done = 0, 0, 0
+    def accumulate (counts):
+        '''Account the counts of the next batches in order, and tell
+        whether the band has settled on one side of threshold.'''
+        nonlocal count, total, done
+        for c in counts:
+            count += c
+            total += sizes[done]
+            done  += 1
+            band = clopper_pearson(count, total, confidence)
+            if band[1] < threshold or band[0] > threshold:
+                return True
+        return False
+    if workers == 1:
+        accumulate(_exceedances(G, T_obs, s, size, k) for s, size in zip(seeds, sizes))
+    else:
+        # The batches are submitted in waves of one per worker, and
+        # the band is checked between waves, so an early stop leaves
+        # at most one wave of batches to waste.
+        wave = workers or os.cpu_count() or 1
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            for start in range(0, len(sizes), wave):
+                futures = [pool.submit(_exceedances, G, T_obs, s, size, k)
+                           for s, size in zip(seeds[start:start+wave], sizes[start:start+wave])]
+                if accumulate(f.result() for f in futures):
+                    break
+    return {"T1"        : float(T_obs),
+            "p_value"   : (count + 1) / (total + 1),
+            "band"      : clopper_pearson(count, total, confidence),
+            "resamples" : total}
+
+# References
+#
+# + [8] https://en.wikipedia.org/wiki/Permutation_test
+#
+# + [9] https://en.wikipedia.org/wiki/Binomial_proportion_confidence_interval#Clopper%E2%80%93Pearson_interval
@@ -0,0 +1,105 @@
+import numpy as np
+import concurrent.futures
+import stats.f_test
+import stats.marietan_test
+
+# We simulate the spiked covariance model of [5]: samples of
+# N(0,\Sigma) in $\mathbb{R}^p$ with
+#
+#  $$\Sigma = I + \sum_{i=1}^{k} (\theta_i - 1) u_i u_i^t,$$
+#
+# where $u_1, .., u_k$ are orthonormal and $\theta_1, .., \theta_k$
+# are the spikes. If $Z \sim N(0, I)$, then
+#
+#  $$Z \Sigma^{1/2} = Z + \sum_{i=1}^{k} (\sqrt{\theta_i} - 1) (Z u_i) u_i^t,$$
+#
+# so a whole batch of samples costs one Gaussian draw and two thin
+# matrix products, and \Sigma itself is never formed. This replaces
+# the Monte-Carlo `higher_normal` commented out in f_test.py.
+#
+# Feeding many replicates of (X, Y) into the tests and counting
+# rejections gives their type-I error (X and Y with the same spikes)
+# and their power (different spikes).
+
+def spiked_samples (rng, replicates, samples, dimension, spikes, directions=None):
+    '''Draw an array of shape (replicates, samples, dimension), each
+    row being a sample of the spiked model. The spike order is
+    len(spikes). directions holds u_1, .., u_k as rows, and defaults
+    to the first k coordinate axes.'''
+    spikes = np.asarray(spikes, dtype=float)
+    Z      = rng.standard_normal((replicates, samples, dimension))
+    if directions is None:
+        Z[..., :len(spikes)] *= np.sqrt(spikes)
+        return Z
+    directions = np.asarray(directions, dtype=float)
+    return Z + ((Z @ directions.T) * (np.sqrt(spikes) - 1)) @ directions
+
+def random_directions (rng, order, dimension):
+    '''order orthonormal directions in dimension, uniformly at random.'''
+    Q, _ = np.linalg.qr(rng.standard_normal((dimension, order)))
+    return Q.T
+
+def _p_values (seed, replicates, samples, dimension, spikes_x, spikes_y, directions, k):
+    '''The p-values of both tests for replicates draws of (X, Y),
+    the T1-test being of spike order k.'''
+    rng = np.random.default_rng(seed)
+    X   = spiked_samples(rng, replicates, samples, dimension, spikes_x, directions)
+    Y   = spiked_samples(rng, replicates, samples, dimension, spikes_y, directions)
+    return {"T1": stats.marietan_test.marietan_T1_test(X, Y, k),
+            "F" : stats.f_test.f_test_higherD_naive(X, Y)}
+
+def _run (tasks, workers):
+    '''Apply _p_values to each tuple of arguments in tasks, in a
+    process pool of workers (in this process if workers == 1).'''
+    if workers == 1:
+        return [_p_values(*task) for task in tasks]
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(_p_values, *zip(*tasks)))
+
+def _tasks (seed, spikes_x, spikes_y, samples, dimension, replicates, directions, chunk, k=None):
+    '''Split the replicates into chunks, each with its own child
+    of seed (an int, None, or a np.random.SeedSequence). The spike
+    order k defaults to len(spikes_x).'''
+    k = len(spikes_x) if k is None else k
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    sizes = [min(chunk, replicates - start) for start in range(0, replicates, chunk)]
+    seeds = seed.spawn(len(sizes))
+    return [(s, size, samples, dimension, spikes_x, spikes_y, directions, k)
+            for s, size in zip(seeds, sizes)]
+
+def _concatenate (results):
+    return {test: np.concatenate([r[test] for r in results]) for test in ["T1", "F"]}
+
+def p_values (spikes_x, spikes_y, samples, dimension, replicates=1000,
+              directions=None, chunk=100, workers=None, seed=None, k=None):
+    '''The p-values of marietan_T1_test ("T1") and
+    f_test_higherD_naive ("F") over replicates independent draws of X
+    and Y, with samples rows each, from the spiked models spikes_x and
+    spikes_y. The replicates are drawn in chunks spread over a process
+    pool, each chunk from its own child of
+    np.random.SeedSequence(seed), so the result only depends on
+    seed. The T1-test is of spike order k, by default the order
+    len(spikes_x) of the model.'''
+    tasks = _tasks(seed, spikes_x, spikes_y, samples, dimension, replicates, directions, chunk, k)
+    return _concatenate(_run(tasks, workers))
+
+def power_curve (spikes, scales, samples, dimension, replicates=1000,
+                 alpha=0.05, directions=None, chunk=100, workers=None, seed=None, k=None):
+    '''The rejection rates of both tests at level alpha, when X has
+    the spikes `spikes` and Y has the spikes scale * spikes, for
+    each scale in scales. At scale 1 this is the type-I error, and
+    elsewhere the power. The T1-test is of spike order k, by default
+    len(spikes). Returns a dict holding "scales" and the rates of
+    "T1" and "F", one per scale.'''
+    spikes = np.asarray(spikes, dtype=float)
+    seeds  = np.random.SeedSequence(seed).spawn(len(scales))
+    tasks  = [_tasks(s, spikes, scale * spikes, samples, dimension, replicates, directions, chunk, k)
+              for scale, s in zip(scales, seeds)]
+    results = _run([task for ts in tasks for task in ts], workers)
+    result  = {"scales": np.asarray(scales, dtype=float), "T1": [], "F": []}
+    for ts in tasks:
+        ps, results = _concatenate(results[:len(ts)]), results[len(ts):]
+        for test in ["T1", "F"]:
+            result[test].append(np.mean(ps[test] < alpha))
+    return {key: np.asarray(value) for key, value in result.items()}
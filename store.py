@@ -0,0 +1,184 @@
+# Usage :: Convert sessions into session stores, e.g.
+#
+#   python store.py ./data/ ./cohort/*/ --output ./stores/
+#
+# A session is either a directory holding `pointi.npy`,
+# `dest_x.npy` and `dest_y.npy` (like `./data/`), or a directory
+# of per-frame archives `disp_frame{frame}_pointf_ref` (see
+# loader.py), in which case `--ids` gives the number of ids.
+#
+# A session store is one file `<name>.session` holding the cleansed
+# session of main.cleanse:
+#
+#   MAGIC | header length (uint32) | JSON header | arrays
+#
+# The header records the metadata and, for each array, its dtype,
+# shape and offset in the file. The arrays are
+#
+#   xy      float64 (points, 2)          the locations, stored once
+#   old_ids int64   (points,)            the columns in the raw data
+#   dxdy    float64 (frames, points, 2)  the displacements, 0 if missing
+#   valid   bool    (frames, points)     whether the displacement was recorded
+#
+# Each array starts on a page boundary and dxdy is stored frame by
+# frame, so opening a store only parses the header, and reading a
+# subset of the frames only touches the pages of those frames. The
+# displacements keep their full precision, so a store gives exactly
+# the p-value of the session it was made from. The header also lists
+# the numbers of the frames stored, which become the frames of the
+# session.
+
+# global modules
+import os
+import re
+import sys
+import json
+import argparse
+import concurrent.futures
+import numpy as np
+# local modules
+import main
+import loader
+
+MAGIC = b"FACESESSION\x00\x00\x00\x00\x01"
+ALIGN = 4096
+
+def write_store (path, session, metadata):
+    '''Write the session into the store at path. The file is written
+    under a temporary name and renamed, so a store is either complete
+    or absent.'''
+    arrays = {"xy"     : np.ascontiguousarray(session.xy, dtype=np.float64),
+              "old_ids": np.ascontiguousarray(session.old_ids, dtype=np.int64),
+              "dxdy"   : np.ascontiguousarray(session.dxdy, dtype=np.float64)}
+    if session.valid is not None:
+        arrays["valid"] = np.ascontiguousarray(session.valid, dtype=bool)
+    # The offsets depend on the length of the header, which depends
+    # on the offsets, so we first reserve a generous header.
+    layout, offset = {}, ALIGN
+    for name, array in arrays.items():
+        layout[name] = {"dtype" : array.dtype.str,
+                        "shape" : array.shape,
+                        "offset": offset}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header = json.dumps({"metadata": metadata, "arrays": layout}).encode()
+    while len(MAGIC) + 4 + len(header) > layout["xy"]["offset"]:
+        for name in layout:
+            layout[name]["offset"] += ALIGN
+        header = json.dumps({"metadata": metadata, "arrays": layout}).encode()
+    temporary = path + ".tmp{}".format(os.getpid())
+    with open(temporary, "wb") as file:
+        file.write(MAGIC)
+        file.write(np.uint32(len(header)).tobytes())
+        file.write(header)
+        for name, array in arrays.items():
+            file.seek(layout[name]["offset"])
+            file.write(array.tobytes())
+    os.replace(temporary, path)
+
+def open_store (path):
+    '''Open the store at path. Returns the metadata and the arrays,
+    which are read-only memory maps of the file.'''
+    with open(path, "rb") as file:
+        assert file.read(len(MAGIC)) == MAGIC, "{} is not a session store.".format(path)
+        length = int(np.frombuffer(file.read(4), dtype=np.uint32)[0])
+        header = json.loads(file.read(length))
+    arrays = {name: np.memmap(path, mode="r", dtype=np.dtype(spec["dtype"]),
+                              offset=spec["offset"], shape=tuple(spec["shape"]))
+              for name, spec in header["arrays"].items()}
+    return header["metadata"], arrays
+
+def open_session (path, frames=None):
+    '''The main.Session in the store at path. frames selects the
+    frames (by position) to read, as a slice or an array of indices;
+    by default all of them are mapped, and nothing is read until
+    used. The frames of the session are the numbers of the frames
+    read, as listed in the header, and its valid mask is None for
+    stores written without one.'''
+    metadata, arrays = open_store(path)
+    numbers = metadata.get("frames", list(range(0, len(arrays["dxdy"]))))
+    if frames is not None:
+        numbers = np.asarray(numbers)[frames].tolist()
+    dxdy  = arrays["dxdy"] if frames is None else arrays["dxdy"][frames]
+    valid = arrays.get("valid")
+    if valid is not None and frames is not None:
+        valid = valid[frames]
+    return main.Session(xy      = np.asarray(arrays["xy"]),
+                        dxdy    = dxdy,
+                        old_ids = np.asarray(arrays["old_ids"]),
+                        frames  = numbers,
+                        x_mean  = float(arrays["xy"][:, 0].mean()),
+                        valid   = valid)
+
+def per_frame_profile (directory, ids):
+    '''A profile (see loader.py) for the per-frame archives found in
+    directory.'''
+    pattern = re.compile(r"disp_frame(\d+)_pointf_ref$")
+    frames  = sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(directory))
+                     if match)
+    return {'name'    : os.path.basename(os.path.normpath(directory)),
+            'get_file': lambda frame: os.path.join(directory, "disp_frame{}_pointf_ref".format(frame)),
+            'ids'     : range(0, ids),
+            'frames'  : frames}
+
+def ingest (source, destination, ids=None):
+    '''Convert the session at source (either layout) into the store
+    at destination. Returns the path of the store.'''
+    if os.path.isfile(os.path.join(source, "pointi.npy")):
+        pointi = np.load(os.path.join(source, "pointi.npy"))
+        dest_x = np.load(os.path.join(source, "dest_x.npy"))
+        dest_y = np.load(os.path.join(source, "dest_y.npy"))
+        frames = list(range(0, len(pointi)))
+        layout = "npy"
+    else:
+        assert ids is not None, "The number of ids of {} is needed.".format(source)
+        profile = per_frame_profile(source, ids)
+        decoded = [f for f in loader.read_frames(profile) if f is not None]
+        pointi  = np.stack([f.pointi for f in decoded])
+        dest_x  = np.stack([f.dest_x for f in decoded])
+        dest_y  = np.stack([f.dest_y for f in decoded])
+        frames  = [f.frame for f in decoded]
+        layout  = "per-frame"
+    session = main.cleanse(pointi, dest_x, dest_y)
+    metadata = {"name"  : os.path.basename(os.path.normpath(source)),
+                "source": os.path.abspath(source),
+                "layout": layout,
+                "frames": frames,
+                "points": len(session.old_ids)}
+    write_store(destination, session, metadata)
+    return destination
+
+def ingest_all (sources, output, ids=None, workers=None):
+    '''Ingest each source into `<output>/<name>.session` in a process
+    pool, yielding (source, store or error) as they finish.'''
+    os.makedirs(output, exist_ok=True)
+    def destination (source):
+        return os.path.join(output, os.path.basename(os.path.normpath(source)) + ".session")
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = {pool.submit(ingest, source, destination(source), ids): source
+                   for source in sources}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as error:
+                yield futures[future], error
+
+def cli (argv=None):
+    parser = argparse.ArgumentParser(description="Convert sessions into session stores.")
+    parser.add_argument("sources", nargs="+", help="session directories")
+    parser.add_argument("--output", required=True, help="directory of the stores")
+    parser.add_argument("--ids", type=int, default=None,
+                        help="number of ids, for the per-frame layout")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes (default: cores)")
+    args = parser.parse_args(argv)
+    failed = False
+    for source, result in ingest_all(args.sources, args.output, args.ids, args.workers):
+        if isinstance(result, Exception):
+            failed = True
+            print("{}: {}".format(source, result), file=sys.stderr)
+        else:
+            print(result)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    cli()
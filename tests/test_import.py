@@ -0,0 +1,9 @@
+import bench
+
+def test_importing_main_is_cheap ():
+    # In a fresh interpreter, from an empty directory, like bench.py
+    # --import-budget.
+    cost = bench.import_cost("main")
+    assert cost["seconds"] <= bench.IMPORT_BUDGET
+    assert cost["heavy"] == []
+    assert cost["printed"] == []
@@ -0,0 +1,33 @@
+import numpy as np
+import stats.influence
+import stats.marietan_test as mt
+
+def sample (m, p, rng=np.random.default_rng(0)):
+    '''L and R of m frames and p columns, with a few spikes each.'''
+    L, R = rng.normal(size=(m, p)), rng.normal(size=(m, p))
+    L[:, :6]  *= 5
+    R[:, 2:5] *= 4
+    return L, R
+
+def T1 (X, Y, k=mt.SPIKE_ORDER):
+    return float(mt.T_1(mt.centralize(X), mt.centralize(Y), k))
+
+def test_leave_one_out_matches_rerunning_the_test ():
+    # Both the scatter (m <= p) and the Gram (m > p) forms.
+    for m, p in [(20, 60), (60, 20)]:
+        L, R   = sample(m, p)
+        result = stats.influence.leave_one_out(L, R)
+        keep   = lambda f: np.arange(m) != f
+        brute  = np.array([T1(L[keep(f)], R[keep(f)]) for f in range(m)])
+        assert np.allclose(result["T1_without"], brute, rtol=1e-10, atol=0)
+        assert np.isclose(result["T1"], T1(L, R), rtol=1e-10, atol=0)
+
+def test_pair_contributions_match_rerunning_the_test ():
+    for m, p in [(12, 40), (40, 12)]:
+        L, R   = sample(m, p)
+        result = stats.influence.pair_contributions(L, R)
+        keep   = lambda j: ~np.isin(np.arange(p), [2*j, 2*j + 1])
+        brute  = np.array([T1(L[:, keep(j)], R[:, keep(j)]) for j in range(p // 2)])
+        assert np.allclose(result["T1_without"], brute, rtol=1e-10, atol=0)
+        assert np.allclose(result["contribution"], result["T1"] - brute,
+                           rtol=0, atol=1e-10 * np.abs(brute).max())
@@ -0,0 +1,41 @@
+import time
+import warnings
+import threading
+import contextlib
+import numpy as np
+import loader
+
+def profile (frames, ids=4, delay=lambda frame: 0, fails=lambda frame, attempt: False):
+    '''A profile of in-memory frames, whose reads of a frame take
+    delay(frame) seconds and fail when fails(frame, attempt).'''
+    attempts = {}
+    lock     = threading.Lock()
+    def load (frame, allow_pickle=False):
+        with lock:
+            attempts[frame] = attempt = attempts.get(frame, 0) + 1
+        time.sleep(delay(frame))
+        if fails(frame, attempt):
+            raise OSError("read error")
+        idx = np.arange(ids)
+        xy  = np.stack([np.arange(ids) - (ids - 1)/2, np.zeros(ids)], axis=1)
+        return contextlib.nullcontext({"idx": idx, "pointi": xy, "pointf": xy + frame})
+    return {'name': "memory", 'get_file': lambda frame: frame, 'load': load,
+            'ids': range(0, ids), 'frames': frames}
+
+def test_slow_reads_keep_the_frame_order ():
+    # The earlier frames are the slowest, so they finish last.
+    frames = list(range(12))
+    result = list(loader.read_frames(profile(frames, delay=lambda frame: 0.02*(12 - frame)),
+                                     workers=4))
+    assert [f.frame for f in result] == frames
+    assert [f.dest_x[0] for f in result] == frames
+
+def test_failed_frames_are_reported ():
+    fails = lambda frame, attempt: frame == 3 or (frame == 5 and attempt == 1)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        session = loader.load_session(profile(list(range(8)), fails=fails),
+                                      workers=3, backoff=0.001)
+    assert list(session.frames) == [0, 1, 2, 4, 5, 6, 7]
+    assert session.dxdy[:, 0, 0].tolist() == [0, 1, 2, 4, 5, 6, 7]
+    assert any("[3]" in str(warning.message) for warning in caught)
@@ -0,0 +1,36 @@
+import numpy as np
+import stats.marietan_test as mt
+
+def spectrum (spikes, bulk=20, padding=0, rng=np.random.default_rng(0)):
+    '''A spectrum of the given spikes over a bulk of eigenvalues near
+    1, padded with zeros like the dual form.'''
+    eigvals = np.concatenate([spikes, 1 + 0.1 * rng.random(bulk), np.zeros(padding)])
+    return mt.Spectrum(np.sort(eigvals)[::-1])
+
+def test_spike_order_finds_the_gap ():
+    for k in [1, 2, 3, 5]:
+        spikes = 40 * 0.8**np.arange(k)
+        assert mt.spike_order(spectrum(spikes), 8) == k
+
+def test_spike_order_ignores_the_zeros ():
+    # With the bulk shorter than k_max, the ratios reach the padding.
+    for k in [1, 2, 3]:
+        spikes = 40 * 0.8**np.arange(k)
+        assert mt.spike_order(spectrum(spikes, bulk=2, padding=10), 8) == k
+        near   = spectrum(spikes, bulk=2, padding=10)
+        near.eigvals[-10:] = 1e-18 * np.arange(10, 0, -1)
+        assert mt.spike_order(near, 8) == k
+
+def test_spike_order_of_a_dual_sample ():
+    rng = np.random.default_rng(1)
+    X   = rng.standard_normal((60, 8))
+    X[:, :3] *= [12, 9, 7]
+    assert mt.spike_order(mt.spectrum(mt.centralize(X)), 10) == 3
+
+def test_hat_hat_Sigma_adds_the_spikes_along_their_eigenvectors ():
+    X = np.random.default_rng(0).normal(size=(10, 30))
+    X[:, :3] *= 10
+    S = mt.spectrum(mt.centralize(X))
+    theta  = mt.hat_hat_theta(np.arange(3), S, 3)
+    spikes = sum(theta[s] * np.outer(S.eigvecs[:, s], S.eigvecs[:, s]) for s in range(3))
+    assert np.allclose(mt.hat_hat_Sigma(S, 3), np.identity(10) + spikes)
@@ -0,0 +1,33 @@
+import numpy as np
+import main
+import online
+import stats.marietan_test as mt
+
+def recording (frames=40, pairs=4, rng=np.random.default_rng(0)):
+    '''The raw arrays of stage_1 for mirrored pairs of points, with a
+    few displacements missing.'''
+    x, y   = rng.uniform(1, 10, pairs), rng.uniform(-10, 10, pairs)
+    pointi = np.tile(np.concatenate([-x, x + 0.1, y, y]), (frames, 1))
+    dest_x = rng.normal(size=(frames, 2*pairs))
+    dest_y = rng.normal(size=(frames, 2*pairs))
+    dest_x[rng.random(dest_x.shape) < 0.05] = np.nan
+    return pointi, dest_x, dest_y
+
+def test_updates_match_a_full_recompute ():
+    pointi, dest_x, dest_y = recording()
+    session = main.cleanse(pointi, dest_x, dest_y)
+    # With p = 8 coordinates, the windows below and above p keep the
+    # Gram and the scatter matrices, and no window both in turn.
+    for window in [None, 5, 12]:
+        replay = online.OnlineSession(pointi[0], dest_x[0], dest_y[0], window=window)
+        L, R   = main.stage_3(replay.left_ids, replay.right_ids, session)
+        for frame in range(1, len(pointi)):
+            record = replay.append(dest_x[frame], dest_y[frame])
+            first  = 0 if window is None else max(0, frame + 1 - window)
+            X, Y   = L[first:frame+1], R[first:frame+1]
+            assert record["frames"] == len(X)
+            if len(X) < mt.SPIKE_ORDER + 2:
+                assert np.isnan(record["T1"])
+            else:
+                T1 = float(mt.T_1(mt.centralize(X), mt.centralize(Y)))
+                assert np.isclose(record["T1"], T1, rtol=1e-12, atol=0)
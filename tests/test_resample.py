@@ -0,0 +1,21 @@
+import numpy as np
+import concurrent.futures
+import stats.resample
+
+def test_the_pool_stops_early_like_one_process (monkeypatch):
+    rng  = np.random.default_rng(0)
+    X, Y = rng.normal(size=(12, 30)), rng.normal(size=(12, 30))
+    X[:, :3] *= 10
+    submitted = []
+    submit    = concurrent.futures.ProcessPoolExecutor.submit
+    def counted (pool, *args, **kwargs):
+        submitted.append(args)
+        return submit(pool, *args, **kwargs)
+    monkeypatch.setattr(concurrent.futures.ProcessPoolExecutor, "submit", counted)
+    options = dict(resamples=4000, batch=100, seed=1)
+    alone   = stats.resample.marietan_T1_resampling_test(X, Y, workers=1, **options)
+    pooled  = stats.resample.marietan_T1_resampling_test(X, Y, workers=2, **options)
+    assert alone == pooled
+    assert alone["resamples"] < 4000
+    # At most the last wave of two batches goes to waste.
+    assert len(submitted) * 100 <= alone["resamples"] + 2 * 100
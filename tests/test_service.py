@@ -0,0 +1,37 @@
+import io
+import json
+import asyncio
+import numpy as np
+import service
+
+async def request (port, body, content_type="application/json"):
+    '''The status and the payload of POST /jobs with body.'''
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write("POST /jobs HTTP/1.1\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n"
+                 .format(content_type, len(body)).encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(payload)
+
+def bad_requests ():
+    npy = io.BytesIO()
+    np.save(npy, np.zeros(3))
+    return [(b"[]", "application/json"),
+            (b'"x"', "application/json"),
+            (b"{not json", "application/json"),
+            (b'{"session": 1}', "application/json"),
+            (npy.getvalue(), "application/octet-stream"),
+            (b"garbage", "application/octet-stream")]
+
+def test_bad_requests_get_400 ():
+    async def run ():
+        # No job is submitted, so the worker pool is never started.
+        server = await asyncio.start_server(service.Service(workers=1).handle, "127.0.0.1", 0)
+        port   = server.sockets[0].getsockname()[1]
+        async with server:
+            return [await request(port, body, content_type) for body, content_type in bad_requests()]
+    for status, payload in asyncio.run(run()):
+        assert status == 400
+        assert "error" in payload
@@ -0,0 +1,23 @@
+import numpy as np
+import main
+
+def face (points=600, rng=np.random.default_rng(0)):
+    '''Points spread unevenly over the two halves of a face, so that
+    the points of the denser half must pair far across the midline.'''
+    left  = rng.random((points, 2)) * [-100, 200]
+    right = rng.random((points, 2))**[2, 1] * [100, 200]
+    xy    = np.concatenate([left, right])
+    return xy, xy * [-1, 1]
+
+def cost (xy, xy_mirrored, match):
+    return np.linalg.norm(xy[match] - xy_mirrored, axis=1).sum()
+
+def test_sparse_match_pairs_with_itself_like_dense ():
+    xy, xy_mirrored = face()
+    dense  = main.dense_match(xy, xy_mirrored)
+    ids    = np.arange(len(xy))
+    for neighbours in [3, 10]:
+        sparse = main.sparse_match(xy, xy_mirrored, neighbours)
+        assert sorted(sparse) == list(ids)
+        assert np.count_nonzero(sparse == ids) <= np.count_nonzero(dense == ids) + 0.01 * len(xy)
+        assert cost(xy, xy_mirrored, sparse) <= 1.05 * cost(xy, xy_mirrored, dense)
@@ -0,0 +1,18 @@
+import numpy as np
+import store
+
+def test_the_mask_of_missing_displacements_is_kept (tmp_path):
+    rng    = np.random.default_rng(0)
+    frames, points = 5, 6
+    pointi = np.tile(np.concatenate([np.arange(points), rng.random(points)]), (frames, 1))
+    dest_x = rng.random((frames, points))
+    dest_y = rng.random((frames, points))
+    dest_x[1, 2] = dest_y[3, 4] = np.nan
+    for name, array in [("pointi", pointi), ("dest_x", dest_x), ("dest_y", dest_y)]:
+        np.save(tmp_path / (name + ".npy"), array)
+    path    = store.ingest(str(tmp_path), str(tmp_path / "session.session"))
+    session = store.open_session(path)
+    valid   = ~np.isnan(dest_x) & ~np.isnan(dest_y)
+    assert np.array_equal(session.valid, valid)
+    assert session.dxdy[1, 2, 0] == session.dxdy[3, 4, 1] == 0
+    assert np.array_equal(store.open_session(path, frames=[1, 3]).valid, valid[[1, 3]])